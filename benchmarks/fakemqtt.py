@@ -0,0 +1,180 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+in-process MQTT broker fake with a paho.mqtt.client.Client compatible
+surface, for the STAMQTTClient benchmarks
+
+broker = FakeBroker(latency=0.001)
+client = STAMQTTClient("fake", client=broker.client())
+"""
+
+import itertools
+import queue
+import threading
+import time
+
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+
+class MessageInfo:
+    def __init__(self, mid, rc):
+        self.mid = mid
+        self.rc = rc
+
+
+class Message:
+    def __init__(self, topic, payload, qos):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+
+
+def topic_matches(pattern, topic):
+    pparts = pattern.split("/")
+    tparts = topic.split("/")
+    for i, p in enumerate(pparts):
+        if p == "#":
+            return True
+        if i >= len(tparts) or (p != "+" and p != tparts[i]):
+            return False
+    return len(pparts) == len(tparts)
+
+
+class FakeBroker:
+    """
+    routes published messages to subscribed fake clients. every publish is
+    confirmed (on_publish) after ``latency`` seconds on the broker thread
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.published = []
+        self._clients = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="fake-broker", daemon=True
+        )
+        self._thread.start()
+
+    def client(self, client_id=""):
+        c = FakeMQTTClient(self, client_id)
+        with self._lock:
+            self._clients.append(c)
+        return c
+
+    def submit(self, sender, mid, topic, payload, qos):
+        self._queue.put((sender, mid, topic, payload, qos, time.time()))
+
+    def _run(self):
+        while 1:
+            sender, mid, topic, payload, qos, ts = self._queue.get()
+            delay = ts + self.latency - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.published.append((topic, payload))
+            with self._lock:
+                clients = list(self._clients)
+            for c in clients:
+                c.deliver(topic, payload, qos)
+            sender.confirm(mid)
+
+
+class FakeMQTTClient:
+    def __init__(self, broker, client_id=""):
+        self._broker = broker
+        self._client_id = client_id
+        self._mids = itertools.count(1)
+        self._subscriptions = {}
+        self.connected = False
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.max_inflight = 20
+
+    def max_inflight_messages_set(self, n):
+        self.max_inflight = n
+
+    def connect(self, host, port=1883, keepalive=60):
+        self.connected = True
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        return MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        return self.connect(None)
+
+    def disconnect(self):
+        self.connected = False
+        if self.on_disconnect:
+            self.on_disconnect(self, None, 0)
+        return MQTT_ERR_SUCCESS
+
+    def drop(self):
+        """
+        simulate an unexpected connection loss followed by a reconnect
+        """
+        self.connected = False
+        if self.on_disconnect:
+            self.on_disconnect(self, None, 1)
+        self.reconnect()
+
+    def loop_start(self):
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        return MQTT_ERR_SUCCESS
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = next(self._mids)
+        if not self.connected:
+            return MessageInfo(mid, MQTT_ERR_NO_CONN)
+        self._broker.submit(self, mid, topic, payload, qos)
+        return MessageInfo(mid, MQTT_ERR_SUCCESS)
+
+    def subscribe(self, topic, qos=0):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for t, q in topics:
+            self._subscriptions[t] = q
+        mid = next(self._mids)
+        if self.on_subscribe:
+            self.on_subscribe(self, None, mid, [q for _, q in topics])
+        return MQTT_ERR_SUCCESS, mid
+
+    def unsubscribe(self, topic):
+        topics = topic if isinstance(topic, list) else [topic]
+        for t in topics:
+            self._subscriptions.pop(t, None)
+        return MQTT_ERR_SUCCESS, next(self._mids)
+
+    def deliver(self, topic, payload, qos):
+        if not self.connected or self.on_message is None:
+            return
+        for pattern in list(self._subscriptions):
+            if topic_matches(pattern, topic):
+                self.on_message(self, None, Message(topic, payload, qos))
+                return
+
+    def confirm(self, mid):
+        if self.on_publish:
+            self.on_publish(self, None, mid)
+
+
+# ============= EOF =============================================
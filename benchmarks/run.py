@@ -0,0 +1,512 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+run the PySTA benchmarks against the in-process stand-in server
+
+python -m benchmarks.run --latency 0.005 --page-size 100 --out bench.json
+python -m benchmarks.run --only get --compare bench.json
+
+every benchmark resets the stand-in, seeds it, and times one PySTA call
+path ``repeat`` times. the median wall time is reported with the
+throughput, the number of requests the server saw and the client side
+request latency. the results carry the git commit so runs of different
+commits can be compared with --compare
+"""
+
+import contextlib
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import click
+
+from sta.cache import IDCache
+from sta.client import Client
+from sta.loader import BulkLoader, make_sites
+from sta.metrics import Metrics
+from sta.sta_client import STAClient, STAMQTTClient
+
+from .fakemqtt import FakeBroker
+from .standin import StandIn
+
+# fine grained latency buckets for a local server
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.002,
+    0.003,
+    0.005,
+    0.0075,
+    0.01,
+    0.015,
+    0.02,
+    0.03,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+)
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+def _locations(n):
+    return [
+        {
+            "name": f"location {i}",
+            "description": "benchmark location",
+            "encodingType": "application/vnd.geo+json",
+            "location": {"type": "Point", "coordinates": [-106.0, 34.0]},
+            "properties": {"agency": "bench", "index": i, "notes": "x" * 200},
+        }
+        for i in range(n)
+    ]
+
+
+def _metadata(server):
+    sensor = server.seed(
+        "Sensors",
+        [
+            {
+                "name": "sensor",
+                "description": "d",
+                "encodingType": "application/pdf",
+                "metadata": "m",
+            }
+        ],
+    )[0]
+    prop = server.seed(
+        "ObservedProperties",
+        [{"name": "depth", "description": "d", "definition": "d"}],
+    )[0]
+    location = server.seed("Locations", _locations(1))[0]
+    thing = server.seed(
+        "Things",
+        [
+            {
+                "name": "thing",
+                "description": "d",
+                "Locations": [{"@iot.id": location}],
+            }
+        ],
+    )[0]
+    datastream = server.seed(
+        "Datastreams",
+        [
+            {
+                "name": "datastream",
+                "description": "d",
+                "observationType": "OM_Measurement",
+                "unitOfMeasurement": {"name": "ft", "symbol": "ft", "definition": "d"},
+                "Thing": {"@iot.id": thing},
+                "Sensor": {"@iot.id": sensor},
+                "ObservedProperty": {"@iot.id": prop},
+            }
+        ],
+    )[0]
+    return sensor, prop, location, thing, datastream
+
+
+def _rows(n):
+    return [
+        [f"2020-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}.000Z", i * 0.5]
+        for i in range(n)
+    ]
+
+
+def _client(server, metrics):
+    return Client(server.base_url, "user", "pwd", id_cache=IDCache(), metrics=metrics)
+
+
+def _sta_client(server, metrics):
+    return STAClient(
+        server.host, "user", "pwd", server.port, id_cache=IDCache(), metrics=metrics
+    )
+
+
+def _get(server, metrics, scale, **kw):
+    n = 20 * scale
+    server.seed("Locations", _locations(n))
+
+    def run():
+        items = list(_client(server, metrics).get_locations(**kw))
+        assert len(items) == n, len(items)
+        return n
+
+    return run
+
+
+@benchmark("get_serial")
+def get_serial(server, metrics, scale):
+    return _get(server, metrics, scale, prefetch=0)
+
+
+@benchmark("get_prefetch")
+def get_prefetch(server, metrics, scale):
+    return _get(server, metrics, scale, prefetch=2)
+
+
+@benchmark("get_parallel")
+def get_parallel(server, metrics, scale):
+    return _get(
+        server, metrics, scale, workers=4, page_size=server.page_size, prefetch=0
+    )
+
+
+@benchmark("observations_put")
+def observations_put(server, metrics, scale):
+    *_, datastream = _metadata(server)
+    rows = _rows(100 * scale)
+
+    def run():
+        payload = {
+            "Datastream": {"@iot.id": datastream},
+            "components": ["phenomenonTime", "result"],
+            "observations": rows,
+        }
+        obs = _client(server, metrics).add_observations(payload)
+        assert all(r.ok for r in obs.results)
+        return len(rows)
+
+    return run
+
+
+@benchmark("put_things")
+def put_things(server, metrics, scale):
+    sensor, prop, location, *_ = _metadata(server)
+    n = scale
+
+    def run():
+        client = _client(server, metrics)
+        for i in range(n):
+            thing = client.put_thing(
+                {
+                    "name": f"well {i}",
+                    "description": "benchmark thing",
+                    "properties": {"index": i},
+                    "Locations": [{"@iot.id": location}],
+                }
+            )
+            datastream = client.put_datastream(
+                {
+                    "name": f"groundwater level {i}",
+                    "description": "d",
+                    "observationType": "OM_Measurement",
+                    "unitOfMeasurement": {
+                        "name": "ft",
+                        "symbol": "ft",
+                        "definition": "d",
+                    },
+                    "Thing": {"@iot.id": int(thing.iotid)},
+                    "Sensor": {"@iot.id": sensor},
+                    "ObservedProperty": {"@iot.id": prop},
+                }
+            )
+            assert datastream.iotid is not None
+        return 2 * n
+
+    return run
+
+
+@benchmark("batch_put_things")
+def batch_put_things(server, metrics, scale):
+    sensor, prop, location, *_ = _metadata(server)
+    n = scale
+
+    def run():
+        with _client(server, metrics).batch(size=50) as batch:
+            datastreams = []
+            for i in range(n):
+                thing = batch.put_thing(
+                    {
+                        "name": f"batch well {i}",
+                        "description": "benchmark thing",
+                        "properties": {"index": i},
+                        "Locations": [{"@iot.id": location}],
+                    }
+                )
+                datastreams.append(
+                    batch.put_datastream(
+                        {
+                            "name": f"groundwater level {i}",
+                            "description": "d",
+                            "observationType": "OM_Measurement",
+                            "unitOfMeasurement": {
+                                "name": "ft",
+                                "symbol": "ft",
+                                "definition": "d",
+                            },
+                            "Thing": {"@iot.id": thing},
+                            "Sensor": {"@iot.id": sensor},
+                            "ObservedProperty": {"@iot.id": prop},
+                        }
+                    )
+                )
+        assert not batch.errors, batch.errors
+        assert all(d.iotid is not None for d in datastreams)
+        return 2 * n
+
+    return run
+
+
+@benchmark("sta_get_locations")
+def sta_get_locations(server, metrics, scale):
+    n = 20 * scale
+    server.seed("Locations", _locations(n))
+
+    def run():
+        items = _sta_client(server, metrics).get_locations()
+        assert len(items) == n, len(items)
+        return n
+
+    return run
+
+
+@benchmark("sta_put")
+def sta_put(server, metrics, scale):
+    sensor, prop, *_ = _metadata(server)
+    n = scale
+
+    def run():
+        client = _sta_client(server, metrics)
+        for i in range(n):
+            lid, _ = client.put_location(
+                f"sta location {i}", "d", {"index": i}, latlon=(34.0, -106.0)
+            )
+            tid = client.put_thing(f"sta well {i}", "d", {"index": i}, lid)
+            client.put_datastream(f"sta level {i}", "d", tid, prop, sensor)
+        return 3 * n
+
+    return run
+
+
+def _sites(server, n):
+    # half of the sites exist, a quarter of those with a changed description
+    rows = [
+        {
+            "name": f"site {i}",
+            "description": "benchmark site",
+            "easting": 350000 + i,
+            "northing": 3800000 + i,
+            "zone": 13,
+            "agency": "bench",
+        }
+        for i in range(n)
+    ]
+    for site in make_sites(rows[: n // 2]):
+        lid = server.seed("Locations", [site.location_payload()])[0]
+        server.seed("Things", [site.thing_payload(lid)])
+
+    for row in rows[: n // 8]:
+        row["description"] = "changed"
+    return rows
+
+
+@benchmark("sta_put_sites")
+def sta_put_sites(server, metrics, scale):
+    rows = _sites(server, 10 * scale)
+
+    def run():
+        client = _sta_client(server, metrics)
+        for row in rows:
+            props = {"agency": row["agency"]}
+            utm = (row["easting"], row["northing"], row["zone"])
+            lid, _ = client.put_location(row["name"], row["description"], props, utm)
+            client.put_thing(row["name"], row["description"], props, lid)
+        return len(rows)
+
+    return run
+
+
+@benchmark("bulk_load")
+def bulk_load(server, metrics, scale):
+    rows = _sites(server, 10 * scale)
+
+    def run():
+        loader = BulkLoader(_sta_client(server, metrics), workers=8)
+        summary = loader.load(rows)
+        assert summary.ok, summary.report()
+        return len(rows)
+
+    return run
+
+
+@benchmark("sta_add_observations")
+def sta_add_observations(server, metrics, scale):
+    *_, datastream = _metadata(server)
+    rows = _rows(100 * scale)
+
+    def run():
+        results = _sta_client(server, metrics).add_observations(
+            datastream, ["phenomenonTime", "result"], rows
+        )
+        assert all(r.ok for r in results)
+        return len(rows)
+
+    return run
+
+
+@benchmark("mqtt_publish")
+def mqtt_publish(server, metrics, scale):
+    # the fake broker confirms each message after the stand-in latency, so
+    # the in-flight window is what bounds throughput
+    rows = _rows(100 * scale)
+    payloads = [{"phenomenonTime": t, "result": r} for t, r in rows]
+
+    def run():
+        broker = FakeBroker(latency=server.latency)
+        with STAMQTTClient(
+            "fake", qos=1, max_in_flight=100, client=broker.client()
+        ) as client:
+            result = client.add_observations(1, payloads)
+        assert result.ok, result
+        return len(payloads)
+
+    return run
+
+
+def run_benchmark(name, server, scale, repeat):
+    metrics = Metrics(BUCKETS)
+    times = []
+    requests = []
+    items = 0
+    for _ in range(repeat):
+        server.reset()
+        run = BENCHMARKS[name](server, metrics, scale)
+        server.nrequests = 0
+        # PySTA reports progress on stdout, keep it out of the timings
+        with contextlib.redirect_stdout(io.StringIO()):
+            st = time.perf_counter()
+            items = run()
+            times.append(time.perf_counter() - st)
+        requests.append(server.nrequests)
+
+    seconds = statistics.median(times)
+    latency = {}
+    for (entity, method), hist in metrics.latency.items():
+        latency[f"{entity} {method}"] = {
+            "count": hist.count,
+            "mean": hist.sum / hist.count if hist.count else 0,
+            "p50": hist.quantile(0.5),
+            "p95": hist.quantile(0.95),
+        }
+
+    return {
+        "items": items,
+        "seconds": seconds,
+        "min_seconds": min(times),
+        "max_seconds": max(times),
+        "throughput": items / seconds if seconds else 0,
+        "requests": statistics.median(requests),
+        "latency": latency,
+    }
+
+
+def git_info():
+    def git(*args):
+        try:
+            return subprocess.check_output(
+                ("git",) + args, stderr=subprocess.DEVNULL, text=True
+            ).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "subject": git("log", "-1", "--format=%s"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+def compare(results, baseline):
+    click.echo(f"{'benchmark':<24}{'items/s':>12}{'baseline':>12}{'change':>9}")
+    for name, r in results.items():
+        base = baseline.get(name)
+        line = f"{name:<24}{r['throughput']:>12.1f}"
+        if base and base["throughput"]:
+            change = r["throughput"] / base["throughput"] - 1
+            line = f"{line}{base['throughput']:>12.1f}{change:>+9.1%}"
+        click.echo(line)
+
+
+@click.command()
+@click.option("--latency", default=0.002, help="stand-in latency per request, s")
+@click.option("--page-size", default=100, help="stand-in maximum page size")
+@click.option("--scale", default=50, help="workload size multiplier")
+@click.option("--repeat", default=3, help="runs per benchmark, the median is kept")
+@click.option("--only", multiple=True, help="benchmark name prefix to run")
+@click.option("--out", default=None, help="write the JSON results to this file")
+@click.option("--compare", "baseline", default=None, help="JSON results to compare")
+def main(latency, page_size, scale, repeat, only, out, baseline):
+    names = [n for n in BENCHMARKS if not only or any(n.startswith(o) for o in only)]
+
+    results = {}
+    with StandIn(latency=latency, page_size=page_size) as server:
+        for name in names:
+            r = results[name] = run_benchmark(name, server, scale, repeat)
+            click.echo(
+                f"{name:<24}{r['items']:>8} items {r['seconds']:>8.3f}s "
+                f"{r['throughput']:>10.1f}/s {r['requests']:>7} requests",
+                err=True,
+            )
+
+    report = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "git": git_info(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {
+            "latency": latency,
+            "page_size": page_size,
+            "scale": scale,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, "w") as wfile:
+            wfile.write(text)
+    else:
+        click.echo(text)
+
+    if baseline:
+        with open(baseline, "r") as rfile:
+            base = json.load(rfile)
+        if base.get("config") != report["config"]:
+            click.secho("baseline config differs, numbers are not comparable", fg="red")
+        compare(results, base.get("results", {}))
+
+
+if __name__ == "__main__":
+    main()
+
+# ============= EOF =============================================
@@ -0,0 +1,533 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+in-process SensorThings stand-in for the benchmarks
+
+implements the subset of FROST used by PySTA: entity collections with
+$top/$skip/$count/$orderby/$select, one level of $expand with $select, and
+@iot.nextLink, $filter on name,
+phenomenonTime and Locations/id, navigation paths such as
+Locations(1)/Things, POST with a Location header, PATCH, DELETE and
+CreateObservations. every request sleeps ``latency`` seconds and pages hold
+at most ``page_size`` entities
+"""
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+ROOT = "/FROST-Server/v1.1"
+
+SINGULAR = {
+    "Locations": "Location",
+    "Things": "Thing",
+    "Datastreams": "Datastream",
+    "Sensors": "Sensor",
+    "ObservedProperties": "ObservedProperty",
+    "Observations": "Observation",
+}
+
+ENTITY = re.compile(r"^(\w+)\((\d+)\)$")
+NAME_FILTER = re.compile(r"name eq '((?:[^']|'')*)'")
+TIME_FILTER = re.compile(r"phenomenonTime (gt|ge|lt|le) ([\w:.\-]+)")
+LOCATION_FILTER = re.compile(r"Locations/id eq (\d+)")
+
+
+class Store:
+    """
+    thread safe entity store. navigation links of an entity are kept in its
+    "_links" dict, {"Thing": 1} or {"Locations": [1, 2]}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._collections = {k: {} for k in SINGULAR}
+            self._ids = {k: 0 for k in SINGULAR}
+
+    def count(self, entity):
+        return len(self._collections[entity])
+
+    @staticmethod
+    def _split(payload):
+        item = {}
+        links = {}
+        for k, v in payload.items():
+            if k[:1].isupper():
+                if isinstance(v, list):
+                    links[k] = [x["@iot.id"] for x in v]
+                else:
+                    links[k] = v["@iot.id"]
+            else:
+                item[k] = v
+        return item, links
+
+    def add(self, entity, payload):
+        item, links = self._split(payload)
+        with self._lock:
+            self._ids[entity] += 1
+            iotid = self._ids[entity]
+            item["@iot.id"] = iotid
+            item["_links"] = links
+            self._collections[entity][iotid] = item
+        return iotid
+
+    def get(self, entity, iotid):
+        return self._collections[entity].get(iotid)
+
+    def patch(self, entity, iotid, payload):
+        with self._lock:
+            item = self._collections[entity].get(iotid)
+            if item is None:
+                return False
+            fields, links = self._split(payload)
+            item.update(fields)
+            item["_links"].update(links)
+            return True
+
+    def delete(self, entity, iotid):
+        with self._lock:
+            return self._collections[entity].pop(iotid, None) is not None
+
+    def items(self, entity, parent=None):
+        """
+        the entities of ``entity``, or those linked to ``parent``, a
+        (entity, iotid) tuple
+        """
+        with self._lock:
+            values = list(self._collections[entity].values())
+            if parent is None:
+                return values
+
+            pentity, pid = parent
+            pitem = self._collections[pentity].get(pid)
+            if pitem is None:
+                return []
+
+            # links held by the parent, e.g. Things(1)/Locations
+            linked = pitem["_links"].get(entity, pitem["_links"].get(SINGULAR[entity]))
+            if linked is not None:
+                ids = linked if isinstance(linked, list) else [linked]
+                items = self._collections[entity]
+                return [items[i] for i in ids if i in items]
+
+            # links held by the children, e.g. Locations(1)/Things
+            out = []
+            for v in values:
+                link = v["_links"].get(pentity, v["_links"].get(SINGULAR[pentity]))
+                if link == pid or (isinstance(link, list) and pid in link):
+                    out.append(v)
+            return out
+
+
+def _public(item, select=None):
+    if select:
+        return {
+            ("@iot.id" if k == "id" else k): item.get("@iot.id" if k == "id" else k)
+            for k in select
+        }
+    return {k: v for k, v in item.items() if k != "_links"}
+
+
+def _split_top(expr, sep):
+    """
+    split ``expr`` on the ``sep`` characters outside parentheses
+    """
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(expr):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == sep and not depth:
+            parts.append(expr[start:i])
+            start = i + 1
+    parts.append(expr[start:])
+    return [p for p in parts if p]
+
+
+def _expand(store, entity, item, expr, iotid=None):
+    """
+    add the related entities named in an $expand expression such as
+    "Things($select=id,name),Datastreams($expand=Sensor($select=id))" to
+    ``item``. ``iotid`` defaults to the id of ``item``
+    """
+    if iotid is None:
+        iotid = item["@iot.id"]
+    plural = {v: k for k, v in SINGULAR.items()}
+    for part in _split_top(expr, ","):
+        name, _, options = part.partition("(")
+        select = nested = None
+        for option in _split_top(options[:-1], ";"):
+            key, _, value = option.partition("=")
+            if key == "$select":
+                select = value.split(",")
+            elif key == "$expand":
+                nested = value
+
+        related_entity = plural.get(name, name)
+        related = store.items(related_entity, (entity, iotid))
+        values = []
+        for r in related:
+            public = _public(r, select)
+            if nested:
+                _expand(store, related_entity, public, nested, r["@iot.id"])
+            values.append(public)
+
+        if name in plural:
+            item[name] = values[0] if values else None
+        else:
+            item[name] = values
+    return item
+
+
+def _apply_filter(items, expr):
+    m = NAME_FILTER.search(expr)
+    if m:
+        name = m.group(1).replace("''", "'")
+        items = [i for i in items if i.get("name") == name]
+
+    for op, value in TIME_FILTER.findall(expr):
+        cmp = {
+            "gt": lambda a: a > value,
+            "ge": lambda a: a >= value,
+            "lt": lambda a: a < value,
+            "le": lambda a: a <= value,
+        }[op]
+        items = [
+            i for i in items if i.get("phenomenonTime") and cmp(i["phenomenonTime"])
+        ]
+
+    lids = {int(x) for x in LOCATION_FILTER.findall(expr)}
+    if lids:
+        items = [i for i in items if lids & set(i["_links"].get("Locations", []))]
+    return items
+
+
+def _apply_orderby(items, orderby):
+    field, _, direction = orderby.partition(" ")
+    key = "@iot.id" if field == "id" else field
+    return sorted(
+        items,
+        key=lambda i: (i.get(key) is None, i.get(key)),
+        reverse=direction == "desc",
+    )
+
+
+def _resolve_refs(obj, ids):
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            if k == "@iot.id" and isinstance(v, str) and v.startswith("$"):
+                v = ids[v[1:]]
+            out[k] = _resolve_refs(v, ids)
+        return out
+    elif isinstance(obj, list):
+        return [_resolve_refs(v, ids) for v in obj]
+    return obj
+
+
+def _batch_request(store, request, ids):
+    """
+    run one request of a $batch. returns (status, entity, iotid)
+    """
+    for cid in request.get("dependsOn", []):
+        if cid not in ids:
+            return 400, None, None
+    try:
+        body = _resolve_refs(request.get("body") or {}, ids)
+    except KeyError:
+        # a content-ID that was not created before this request
+        return 400, None, None
+
+    method = request["method"].lower()
+    url = request["url"]
+    m = ENTITY.match(url)
+    if method == "post" and url in SINGULAR:
+        return 201, url, store.add(url, body)
+    elif method == "patch" and m:
+        ok = store.patch(m.group(1), int(m.group(2)), body)
+        return (200 if ok else 404), m.group(1), int(m.group(2))
+    return 400, None, None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send headers and body in one segment, an unbuffered writer splits them
+    # and trips Nagle + delayed ACK stalls on keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def standin(self):
+        return self.server.standin
+
+    def _send(self, code, body=None, headers=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        n = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(n) or b"null")
+
+    def _path(self):
+        parts = urlsplit(self.path)
+        path = parts.path
+        if not path.startswith(ROOT):
+            return None, parts
+        return path[len(ROOT) :].strip("/"), parts
+
+    def _begin(self):
+        self.standin.count_request()
+        if self.standin.latency:
+            time.sleep(self.standin.latency)
+
+    def do_GET(self):
+        self._begin()
+        path, parts = self._path()
+        if not path:
+            return self._send(404, {"message": "not found"})
+
+        segments = path.split("/")
+        m = ENTITY.match(segments[-1])
+        if m and len(segments) == 1:
+            item = self.standin.store.get(m.group(1), int(m.group(2)))
+            if item is None:
+                return self._send(404, {"message": "not found"})
+            public = _public(item)
+            expand = parse_qs(parts.query).get("$expand")
+            if expand:
+                _expand(self.standin.store, m.group(1), public, expand[0])
+            return self._send(200, public)
+
+        entity = segments[-1]
+        if entity not in SINGULAR:
+            return self._send(404, {"message": f"unknown entity {entity}"})
+
+        parent = None
+        if len(segments) == 2:
+            pm = ENTITY.match(segments[0])
+            if pm is None:
+                return self._send(400, {"message": "bad path"})
+            parent = (pm.group(1), int(pm.group(2)))
+
+        q = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        if q.get("$resultFormat"):
+            return self._send(400, {"message": "$resultFormat not supported"})
+
+        items = self.standin.store.items(entity, parent)
+        if q.get("$filter"):
+            items = _apply_filter(items, q["$filter"])
+        items = _apply_orderby(items, q.get("$orderby", "id asc"))
+
+        skip = int(q.get("$skip", 0))
+        top = min(int(q.get("$top", self.standin.page_size)), self.standin.page_size)
+        page = items[skip : skip + top]
+
+        select = q["$select"].split(",") if q.get("$select") else None
+        body = {}
+        if q.get("$count") == "true":
+            body["@iot.count"] = len(items)
+        if skip + top < len(items):
+            q["$skip"] = str(skip + top)
+            host = self.headers.get("Host")
+            query = urlencode(q, quote_via=quote, safe="$,()'=;/:@*")
+            body["@iot.nextLink"] = f"http://{host}{parts.path}?{query}"
+        body["value"] = [_public(i, select) for i in page]
+        if q.get("$expand"):
+            store = self.standin.store
+            for public, item in zip(body["value"], page):
+                _expand(store, entity, public, q["$expand"])
+        self._send(200, body)
+
+    def do_POST(self):
+        self._begin()
+        path, _ = self._path()
+        payload = self._read_json()
+        if path == "CreateObservations":
+            return self._create_observations(payload)
+        if path == "$batch":
+            return self._batch(payload)
+        if path not in SINGULAR:
+            return self._send(404, {"message": f"unknown entity {path}"})
+
+        iotid = self.standin.store.add(path, payload)
+        location = f"http://{self.headers.get('Host')}{ROOT}/{path}({iotid})"
+        self._send(201, None, {"Location": location})
+
+    def _create_observations(self, payload):
+        host = self.headers.get("Host")
+        links = []
+        store = self.standin.store
+        for block in payload:
+            datastream = block["Datastream"]
+            components = block["components"]
+            for row in block["dataArray"]:
+                obs = dict(zip(components, row))
+                obs["Datastream"] = datastream
+                iotid = store.add("Observations", obs)
+                links.append(f"http://{host}{ROOT}/Observations({iotid})")
+        self._send(201, links)
+
+    def _batch(self, payload):
+        """
+        run an OData JSON $batch. the requests of an atomicity group must be
+        adjacent, the entities created by a group are removed again when one
+        of its requests fails
+        """
+        requests = payload.get("requests", [])
+        chunks = []
+        for request in requests:
+            group = request.get("atomicityGroup")
+            if group is not None and chunks and chunks[-1][0] == group:
+                chunks[-1][1].append(request)
+            elif group is not None and any(g == group for g, _ in chunks):
+                return self._send(
+                    400, {"message": f"atomicity group {group} is not adjacent"}
+                )
+            else:
+                chunks.append((group, [request]))
+
+        host = self.headers.get("Host")
+        store = self.standin.store
+        ids = {}
+        responses = []
+        for group, chunk in chunks:
+            results = []
+            created = []
+            for request in chunk:
+                status, entity, iotid = _batch_request(store, request, ids)
+                if status == 201:
+                    ids[request["id"]] = iotid
+                    created.append((entity, iotid))
+                results.append((request, status, entity, iotid))
+                if status >= 400:
+                    break
+
+            failed = results[-1][1] >= 400
+            if failed and group is not None:
+                for entity, iotid in created:
+                    store.delete(entity, iotid)
+                status = results[-1][1]
+                for request in chunk:
+                    ids.pop(request["id"], None)
+                    responses.append({"id": request["id"], "status": status})
+                continue
+
+            for request, status, entity, iotid in results:
+                response = {"id": request["id"], "status": status}
+                if status == 201:
+                    response["headers"] = {
+                        "location": f"http://{host}{ROOT}/{entity}({iotid})"
+                    }
+                responses.append(response)
+        self._send(200, {"responses": responses})
+
+    def do_PATCH(self):
+        self._begin()
+        path, _ = self._path()
+        m = ENTITY.match(path or "")
+        if m is None:
+            return self._send(400, {"message": "bad path"})
+
+        if self.standin.store.patch(m.group(1), int(m.group(2)), self._read_json()):
+            return self._send(200, {})
+        self._send(404, {"message": "not found"})
+
+    def do_DELETE(self):
+        self._begin()
+        path, _ = self._path()
+        m = ENTITY.match(path or "")
+        if m and self.standin.store.delete(m.group(1), int(m.group(2))):
+            return self._send(200, {})
+        self._send(404, {"message": "not found"})
+
+
+class StandIn:
+    """
+    with StandIn(latency=0.005, page_size=100) as server:
+        client = Client(server.base_url, "user", "pwd")
+    """
+
+    def __init__(self, latency=0.0, page_size=100, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.page_size = page_size
+        self.store = Store()
+        self.nrequests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._server.standin = self
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}{ROOT}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="sta-standin", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count_request(self):
+        with self._lock:
+            self.nrequests += 1
+
+    def reset(self):
+        self.store.reset()
+        with self._lock:
+            self.nrequests = 0
+
+    def seed(self, entity, payloads):
+        return [self.store.add(entity, p) for p in payloads]
+
+
+# ============= EOF =============================================
@@ -37,12 +37,19 @@ setup(
         "jsonschema==3",
         "pyyaml",
     ],
+    extras_require={
+        "async": ["aiohttp"],
+        "numpy": ["numpy"],
+        "arrow": ["numpy", "pyarrow"],
+        "fast": ["orjson"],
+        "stream": ["ijson"],
+    },
     # entry_points={
     #     "console_scripts": [
     #         "sta = sta.cli:cli",
     #     ],
     # },
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     # include_package_data=True,
     packages=["sta"],
     # package_data={
@@ -0,0 +1,597 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import asyncio
+import time
+from collections import deque
+
+import aiohttp
+import click
+from multidict import CIMultiDict
+
+from . import client
+from .cache import PreloadIndex, resolve_id_cache
+from .client import ValidationPolicy, load_connection, verbose_message, warning
+from .diff import diff, link_expand
+from .jsonlib import json_kwargs, loads
+from .upload import ChunkResult, make_sizer, parse_create_observations
+
+_END = object()
+
+
+class AsyncResponse:
+    """
+    a fully read response exposing the subset of requests.Response that
+    BaseST._parse_response relies on
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def __repr__(self):
+        return f"<AsyncResponse [{self.status_code}]>"
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return loads(self.content)
+
+
+class AsyncTransport:
+    """
+    shared aiohttp connection pool. ``concurrency`` bounds the number of
+    requests in flight across every entity using this transport
+    """
+
+    def __init__(
+        self, connection, concurrency=100, pool_size=100, connect_timeout=10, timeout=60
+    ):
+        self._connection = connection
+        self._concurrency = concurrency
+        self._pool_size = pool_size
+        self._connect_timeout = connect_timeout
+        self._timeout = timeout
+        self._session = None
+        self._semaphore = None
+
+    def _get_session(self):
+        # the session and semaphore must be created inside the running loop
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._pool_size)
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=self._connect_timeout, sock_read=self._timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+        return self._session
+
+    async def request(self, method, url, **kw):
+        session = self._get_session()
+        user, pwd = self._connection["user"], self._connection["pwd"]
+        auth = aiohttp.BasicAuth(user, pwd) if user else None
+        async with self._semaphore:
+            kw = json_kwargs(kw)
+            async with session.request(method, url, auth=auth, **kw) as resp:
+                content = await resp.read()
+                return AsyncResponse(resp.status, CIMultiDict(resp.headers), content)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncBaseST:
+    """
+    mixin that replaces the blocking methods of BaseST with coroutines. request
+    generation, validation and response parsing are shared with BaseST
+    """
+
+    async def _send_request(self, request, dry=False, verbose=True, **kw):
+        if not dry:
+            resp = await self._session.request(request["method"], request["url"], **kw)
+            if verbose:
+                if resp and resp.status_code not in (200, 201):
+                    print(f"request={request}")
+                    print(f"response={resp}")
+            return resp
+
+    async def get(
+        self,
+        query,
+        entity=None,
+        pages=None,
+        expand=None,
+        limit=None,
+        verbose=False,
+        orderby=None,
+        prefetch=1,
+        spec=None,
+    ):
+        if pages and pages < 0:
+            pages = abs(pages)
+            orderby = "$orderby=id desc"
+
+        async def fetch(url, page_count):
+            request = {"method": "get", "url": url}
+            if verbose:
+                pv = ""
+                if pages:
+                    pv = f"/{pages}"
+
+                verbose_message(f"getting page={page_count + 1}{pv} - url={url}")
+
+            resp = await self._send_request(request)
+            resp = self._parse_response(request, resp)
+            if not resp:
+                click.secho(url, fg="red")
+            return resp
+
+        async def iter_pages(url):
+            page_count = 0
+            while url:
+                if pages and page_count >= pages:
+                    return
+
+                page = await fetch(url, page_count)
+                yield page
+                if not page:
+                    return
+
+                url = page.get("@iot.nextLink")
+                page_count += 1
+
+        async def produce(q, url):
+            try:
+                async for page in iter_pages(url):
+                    await q.put(page)
+            except asyncio.CancelledError:
+                # the consumer stopped, nobody reads the queue anymore
+                raise
+            except Exception as e:
+                await q.put(e)
+                return
+            await q.put(_END)
+
+        start_request = self._generate_request(
+            "get",
+            query=query,
+            entity=entity,
+            orderby=orderby,
+            expand=expand,
+            limit=limit,
+            spec=spec,
+        )
+
+        q = asyncio.Queue(maxsize=max(1, prefetch))
+        producer = asyncio.ensure_future(produce(q, start_request["url"]))
+        yielded = 0
+        try:
+            while 1:
+                page = await q.get()
+                if page is _END or not page:
+                    return
+                if isinstance(page, BaseException):
+                    raise page
+
+                if not page["value"]:
+                    warning("no records found")
+                    return
+
+                for v in page["value"]:
+                    if limit and yielded >= limit:
+                        return
+
+                    yielded += 1
+                    yield v
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+
+    async def getfirst(self, *args, **kw):
+        gen = self.get(*args, **kw)
+        try:
+            return await gen.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            await gen.aclose()
+
+    async def exists(self):
+        known = self._local_exists()
+        if known is not None:
+            return known
+        return await self._lookup()
+
+    async def _lookup(self):
+        query, entity = self._exists_query()
+        resp = await self.getfirst(
+            query, entity=entity, expand=link_expand(self._payload)
+        )
+        return self._found(resp)
+
+    async def _existing(self):
+        self._stale = False
+        existing = self._db_obj
+        if self._incomplete():
+            existing = await self._fetch(link_expand(self._payload)) or existing
+        return existing
+
+    async def _fetch(self, expand=None):
+        resp = await self._send_request(self._fetch_request(expand), verbose=False)
+        return self._fetched(resp)
+
+    async def put(self, dry=False, check_exists=True):
+        """
+        see BaseST.put
+        """
+        if self._validate_payload():
+            if check_exists and await self.exists():
+                updated = await self._update(dry)
+                if not self._stale:
+                    return updated
+
+                # the cached id was deleted on the server
+                if await self._lookup():
+                    return await self._update(dry)
+
+            request = self._generate_request("post")
+            print(request)
+            resp = await self._send_request(request, json=self._payload, dry=dry)
+
+            added = self._parse_response(request, resp, dry=dry)
+            if added and not dry:
+                self._cache_iotid()
+            return added
+
+    async def _update(self, dry=False):
+        existing = await self._existing()
+        if self._stale:
+            return
+        if existing is None:
+            return await self.patch(dry)
+
+        self.changes = diff(existing, self._payload)
+        if not self.changes:
+            return True
+        return await self.patch(dry, self.changes)
+
+    async def patch(self, dry=False, payload=None):
+        if self._validate_payload():
+            if payload is None:
+                payload = self._payload
+            self.changes = payload
+
+            request = self._generate_request("patch")
+            resp = await self._send_request(request, json=payload, dry=dry)
+            return self._patch_response(request, resp, payload, dry)
+
+
+# entity classes keep the sync names because the class name is the url segment
+class Things(AsyncBaseST, client.Things):
+    pass
+
+
+class Locations(AsyncBaseST, client.Locations):
+    pass
+
+
+class Sensors(AsyncBaseST, client.Sensors):
+    pass
+
+
+class ObservedProperties(AsyncBaseST, client.ObservedProperties):
+    pass
+
+
+class Datastreams(AsyncBaseST, client.Datastreams):
+    pass
+
+
+class Observations(AsyncBaseST, client.Observations):
+    pass
+
+
+class ObservationsArray(AsyncBaseST, client.ObservationsArray):
+    async def put(
+        self,
+        dry=False,
+        workers=4,
+        chunk_size=None,
+        sizer=None,
+        result_type=None,
+        columns=None,
+    ):
+        """
+        upload the observations as CreateObservations chunks on ``workers``
+        tasks. each task takes the next rows when its previous chunk is done,
+        so at most ``workers`` chunk payloads exist at a time. chunks are sized
+        as in ObservationsArray.put of the sync client. returns a list of
+        ChunkResult ordered by start row
+        """
+        self._load_columns(result_type, columns)
+        if not self._validate_payload():
+            return
+
+        request = self._create_request()
+        obs = self._payload["observations"]
+        nobs = len(obs)
+        self.sizer = make_sizer(chunk_size, sizer)
+        results = []
+        retries = deque()
+        offset = 0
+        index = 0
+
+        def take():
+            nonlocal offset, index
+            size = self.sizer.next_size()
+            if retries:
+                start, stop = retries.popleft()
+                if stop - start > size:
+                    retries.appendleft((start + size, stop))
+                    stop = start + size
+            elif offset < nobs:
+                start, stop = offset, min(offset + size, nobs)
+                offset = stop
+            else:
+                return None, None
+
+            result = ChunkResult(index, start, stop - start)
+            index += 1
+            return result, size
+
+        async def send(result):
+            pd = self._make_chunk_payload(
+                obs[result.start : result.start + result.nrows]
+            )
+            st = time.time()
+            try:
+                resp = await self._send_request(
+                    request, json=pd, dry=dry, verbose=False
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result.error = repr(e)
+                result.timeout = isinstance(e, asyncio.TimeoutError)
+            else:
+                if resp is not None:
+                    parse_create_observations(resp, result)
+            result.elapsed = time.time() - st
+
+        async def work():
+            while 1:
+                result, requested = take()
+                if result is None:
+                    # a retry queued by a chunk still in flight is taken by
+                    # the task that sent it
+                    return
+
+                await send(result)
+                if self.sizer.record(result, requested):
+                    retries.append((result.start, result.start + result.nrows))
+                    continue
+
+                results.append(result)
+                if result.ok:
+                    print(f"loaded chunk {result.start}/{nobs} nrows={result.nrows}")
+                else:
+                    warning(
+                        f"failed loading chunk {result.start}/{nobs}. {result.error}"
+                    )
+
+        tasks = [asyncio.ensure_future(work()) for _ in range(max(1, workers))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        verbose_message(f"chunk sizes {self.sizer.report()}")
+        self.results = sorted(results, key=lambda r: r.start)
+        return self.results
+
+
+class AsyncClient:
+    """
+    asyncio counterpart to sta.client.Client
+
+    async with AsyncClient(base_url, user, pwd, concurrency=200) as client:
+        async for loc in client.get_locations():
+            ...
+    """
+
+    def __init__(
+        self,
+        base_url=None,
+        user=None,
+        pwd=None,
+        concurrency=100,
+        pool_size=100,
+        connect_timeout=10,
+        timeout=60,
+        id_cache=None,
+        validation="strict",
+        sample_rate=0.01,
+    ):
+        self._connection = load_connection(base_url, user, pwd)
+        self._validation = ValidationPolicy(validation, sample_rate)
+        self._id_cache = resolve_id_cache(id_cache)
+        self._index = PreloadIndex()
+        self._session = AsyncTransport(
+            self._connection,
+            concurrency=concurrency,
+            pool_size=pool_size,
+            connect_timeout=connect_timeout,
+            timeout=timeout,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        await self._session.close()
+
+    @property
+    def base_url(self):
+        return self._connection["base_url"]
+
+    @property
+    def id_cache(self):
+        return self._id_cache
+
+    @property
+    def index(self):
+        return self._index
+
+    def _entity(self, klass, payload=None):
+        return klass(
+            payload,
+            self._session,
+            self._connection,
+            self._id_cache,
+            self._index,
+            self._validation,
+        )
+
+    async def put_sensor(self, payload, dry=False):
+        sensor = self._entity(Sensors, payload)
+        await sensor.put(dry)
+        return sensor
+
+    async def put_observed_property(self, payload, dry=False):
+        obs = self._entity(ObservedProperties, payload)
+        await obs.put(dry)
+        return obs
+
+    async def put_datastream(self, payload, dry=False):
+        datastream = self._entity(Datastreams, payload)
+        await datastream.put(dry)
+        return datastream
+
+    async def put_location(self, payload, dry=False):
+        location = self._entity(Locations, payload)
+        await location.put(dry)
+        return location
+
+    async def put_thing(self, payload, dry=False):
+        thing = self._entity(Things, payload)
+        await thing.put(dry)
+        return thing
+
+    async def add_observations(self, payload, dry=False, **kw):
+        obs = self._entity(ObservationsArray, payload)
+        await obs.put(dry, **kw)
+        return obs
+
+    async def add_observation(self, payload, dry=False):
+        obs = self._entity(Observations, payload)
+        await obs.put(dry, check_exists=False)
+        return obs
+
+    async def patch_location(self, iotid, payload, dry=False):
+        location = self._entity(Locations, payload)
+        location.iotid = iotid
+        await location.patch(dry)
+        return location
+
+    async def get_sensors(self, query=None, name=None, **kw):
+        if name is not None:
+            query = f"name eq '{name}'"
+
+        gen = self._entity(Sensors).get(query, **kw)
+        async for item in gen:
+            yield item
+
+    async def get_observed_properties(self, query=None, name=None, **kw):
+        if name is not None:
+            query = f"name eq '{name}'"
+
+        gen = self._entity(ObservedProperties).get(query, **kw)
+        async for item in gen:
+            yield item
+
+    async def get_datastreams(self, query=None, **kw):
+        gen = self._entity(Datastreams).get(query, **kw)
+        async for item in gen:
+            yield item
+
+    async def get_locations(self, query=None, **kw):
+        gen = self._entity(Locations).get(query, **kw)
+        async for item in gen:
+            yield item
+
+    async def get_things(self, query=None, **kw):
+        gen = self._entity(Things).get(query, **kw)
+        async for item in gen:
+            yield item
+
+    async def get_location(self, query=None, name=None, **kw):
+        if name is not None:
+            query = f"name eq '{name}'"
+
+        loc = self._entity(Locations)
+        return await loc.getfirst(query, **kw)
+
+    async def get_thing(self, query=None, name=None, location=None):
+        entity = None
+        if location:
+            if isinstance(location, dict):
+                location = location["@iot.id"]
+            entity = "Locations({})/Things".format(location)
+        if name is not None:
+            query = f"name eq '{name}'"
+
+        thing = self._entity(Things)
+        return await thing.getfirst(query, entity=entity)
+
+    async def get_datastream(self, query=None, name=None, thing=None):
+        entity = None
+        if thing:
+            if isinstance(thing, dict):
+                thing = thing["@iot.id"]
+            entity = f"Things({thing})/Datastreams"
+        if name is not None:
+            query = f"name eq '{name}'"
+
+        datastream = self._entity(Datastreams)
+        return await datastream.getfirst(query, entity=entity)
+
+    async def get_observations(self, datastream, **kw):
+        if isinstance(datastream, dict):
+            datastream = datastream["@iot.id"]
+        entity = f"Datastreams({datastream})/Observations"
+
+        gen = self._entity(Datastreams).get(None, entity=entity, **kw)
+        async for item in gen:
+            yield item
+
+    async def get_observation(self, ptime, result, **kw):
+        query = f"phenomenonTime eq {ptime} and result eq {result}"
+        obs = self._entity(Observations)
+        return await obs.getfirst(query, entity="Observations", **kw)
+
+
+# ============= EOF =============================================
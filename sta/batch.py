@@ -0,0 +1,313 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from .client import (
+    BaseST,
+    Things,
+    Locations,
+    Sensors,
+    ObservedProperties,
+    Datastreams,
+    Observations,
+    IDREGEX,
+    verbose_message,
+    warning,
+)
+from .diff import diff
+from .jsonlib import response_json
+
+
+class BatchOperation:
+    def __init__(self, cid, method, entity, payload=None):
+        self.cid = cid
+        self.method = method
+        self.entity = entity
+        # the request body when it is not the whole entity payload
+        self.payload = payload
+        self.group = self
+
+    def root(self):
+        # union-find over the operations that reference each other
+        op = self
+        while op.group is not op:
+            op.group = op.group.group
+            op = op.group
+        return op
+
+
+def _refs(obj):
+    """
+    yield the entity objects used as {"@iot.id": entity} references in obj
+    """
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k == "@iot.id" and isinstance(v, BaseST):
+                yield v
+            else:
+                yield from _refs(v)
+    elif isinstance(obj, list):
+        for v in obj:
+            yield from _refs(v)
+
+
+def _resolve(obj, resolve):
+    if isinstance(obj, dict):
+        return {
+            k: resolve(v) if isinstance(v, BaseST) else _resolve(v, resolve)
+            for k, v in obj.items()
+        }
+    elif isinstance(obj, list):
+        return [_resolve(v, resolve) for v in obj]
+    return obj
+
+
+def _iotid(entity):
+    iotid = entity.iotid
+    if isinstance(iotid, str) and iotid.isdigit():
+        iotid = int(iotid)
+    return iotid
+
+
+class Batch:
+    """
+    Queue writes and send them as OData JSON $batch requests.
+
+    with client.batch() as b:
+        thing = b.put_thing({..., "Locations": [{"@iot.id": 1}]})
+        b.put_datastream({..., "Thing": {"@iot.id": thing}})
+
+    An entity returned by the batch can be used as an "@iot.id" in later
+    payloads. If it has not been created yet, the dependent request refers to
+    it by content-ID and both are sent in one atomicity group. Every ``size``
+    queued operations are sent as one $batch request. After a flush the
+    returned entities have their iotid set. Failed operations are collected
+    in ``errors``.
+    """
+
+    def __init__(self, client, size=100, check_exists=True, dry=False, verbose=False):
+        self._client = client
+        self._size = size
+        self._check_exists = check_exists
+        self._dry = dry
+        self._verbose = verbose
+        self._queue = []
+        self._ops = {}
+        self._cid = 0
+        self.errors = []
+        self.nrequests = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def put_sensor(self, payload):
+        return self._put(Sensors, payload)
+
+    def put_observed_property(self, payload):
+        return self._put(ObservedProperties, payload)
+
+    def put_datastream(self, payload):
+        return self._put(Datastreams, payload)
+
+    def put_location(self, payload):
+        return self._put(Locations, payload)
+
+    def put_thing(self, payload):
+        return self._put(Things, payload)
+
+    def add_observation(self, payload):
+        return self._put(Observations, payload, check_exists=False)
+
+    def patch_location(self, iotid, payload):
+        location = self._client._entity(Locations, payload)
+        location.iotid = iotid
+        self._queue_op("patch", location)
+        return location
+
+    def flush(self):
+        if not self._queue:
+            return
+
+        queue, self._queue = self._queue, []
+        groups = {}
+        for op in queue:
+            for ref in _refs(op.entity._payload):
+                refop = self._ops.get(id(ref))
+                if refop is not None and ref.iotid is None:
+                    refop.root().group = op.root()
+
+        for op in queue:
+            root = op.root()
+            groups.setdefault(root.cid, []).append(op)
+
+        # the requests of an atomicity group must be adjacent. a group is
+        # emitted where its first operation was queued, its members keep
+        # their queue order, which puts every referenced entity first
+        requests = []
+        sent = []
+        for op in (op for ops in groups.values() for op in ops):
+            depends = []
+
+            def reference(entity):
+                ref = self._reference(entity)
+                # a content-ID reference, the request must run after it
+                if isinstance(ref, str) and ref[1:] not in depends:
+                    depends.append(ref[1:])
+                return ref
+
+            try:
+                payload = op.entity._payload if op.payload is None else op.payload
+                body = _resolve(payload, reference)
+            except ValueError as e:
+                warning(str(e))
+                self.errors.append((op.entity, None, str(e)))
+                continue
+
+            entity = op.entity
+            url = entity.__class__.__name__
+            if op.method == "patch":
+                url = f"{url}({entity.iotid})"
+
+            request = {"id": op.cid, "method": op.method, "url": url, "body": body}
+            if len(groups[op.root().cid]) > 1:
+                request["atomicityGroup"] = f"g{op.root().cid}"
+            if depends:
+                request["dependsOn"] = depends
+
+            requests.append(request)
+            sent.append(op)
+
+        if not requests:
+            return
+
+        if self._verbose:
+            verbose_message(f"sending $batch nrequests={len(requests)}")
+
+        if self._dry:
+            return requests
+
+        try:
+            self._send(requests, sent)
+        finally:
+            for op in queue:
+                self._ops.pop(id(op.entity), None)
+
+    def _send(self, requests, sent):
+        url = f"{self._client._entity(Things)._base_url()}/$batch"
+        connection = self._client._connection
+        resp = self._client._session.post(
+            url,
+            json={"requests": requests},
+            auth=(connection["user"], connection["pwd"]),
+        )
+        self.nrequests += 1
+        if resp.status_code != 200:
+            warning(f"$batch failed {resp.status_code} {resp.text}")
+            self.errors.extend((op.entity, resp.status_code, resp.text) for op in sent)
+            return
+
+        responses = {r["id"]: r for r in response_json(resp).get("responses", [])}
+        for op in sent:
+            self._handle_response(op, responses.get(op.cid))
+
+    def _reference(self, entity):
+        if entity.iotid is not None:
+            return _iotid(entity)
+
+        op = self._ops.get(id(entity))
+        if op is None:
+            raise ValueError(
+                f"{entity.__class__.__name__} {entity._payload.get('name')} "
+                f"was not queued in this batch"
+            )
+        return f"${op.cid}"
+
+    def _handle_response(self, op, response):
+        entity = op.entity
+        if response is None:
+            self.errors.append((entity, None, "no response"))
+            return
+
+        status = response.get("status")
+        if op.method == "post" and status == 201:
+            headers = {k.lower(): v for k, v in response.get("headers", {}).items()}
+            m = IDREGEX.search(headers.get("location", ""))
+            if m:
+                entity.iotid = m.group("id")[1:-1]
+                # now that every reference has an id, store the real payload
+                entity._payload = _resolve(entity._payload, _iotid)
+                entity._cache_iotid()
+                return
+        elif op.method == "patch" and status == 200:
+            entity._patched(op.payload or entity._payload)
+            return
+        elif op.method == "patch" and status == 404:
+            # gone since it was looked up, the next put creates it again
+            entity._forget()
+
+        warning(f"batch {op.method} {entity.__class__.__name__} failed. {response}")
+        self.errors.append((entity, status, response.get("body")))
+
+    def _put(self, klass, payload, check_exists=None):
+        if check_exists is None:
+            check_exists = self._check_exists
+
+        entity = self._client._entity(klass, payload)
+        # validate with references replaced by a placeholder id
+        entity._payload = _resolve(payload, lambda e: 0)
+        valid = entity._validate_payload()
+        pending = any(ref.iotid is None for ref in _refs(payload))
+        if not valid:
+            entity._payload = payload
+            return entity
+
+        # a parent that is created in this batch cannot already have the child
+        method = "post"
+        changes = None
+        if check_exists and not pending:
+            entity._payload = _resolve(payload, _iotid)
+            exists = entity.exists()
+            if exists:
+                existing = entity._existing()
+                if entity._stale:
+                    # the cached id was deleted on the server
+                    exists = entity._lookup()
+                    existing = entity._existing() if exists else None
+            if exists:
+                method = "patch"
+                if existing is not None:
+                    changes = entity.changes = diff(existing, entity._payload)
+
+        entity._payload = payload
+        if changes is not None and not changes:
+            # nothing to PATCH
+            return entity
+
+        self._queue_op(method, entity, changes)
+        return entity
+
+    def _queue_op(self, method, entity, payload=None):
+        self._cid += 1
+        op = BatchOperation(str(self._cid), method, entity, payload)
+        self._ops[id(entity)] = op
+        self._queue.append(op)
+        if len(self._queue) >= self._size:
+            self.flush()
+
+
+# ============= EOF =============================================
@@ -0,0 +1,253 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+TAGREGEX = re.compile(r"^(?P<scope>\w+\(\d+\))/(?P<entity>\w+)$")
+
+
+def payload_scope(entity, payload):
+    """
+    the parent an entity name is unique within. Things are looked up under
+    their Location and Datastreams under their Thing
+    """
+    if entity == "Things":
+        lid = payload["Locations"][0]["@iot.id"]
+        return f"Locations({lid})"
+    elif entity == "Datastreams":
+        tid = payload["Thing"]["@iot.id"]
+        return f"Things({tid})"
+
+
+def location_filter(lids, n=50):
+    """
+    yield $filter expressions selecting Things by Location id, ``n`` ids per
+    expression to keep urls short
+    """
+    lids = list(lids)
+    for i in range(0, len(lids), n):
+        yield " or ".join(f"Locations/id eq {lid}" for lid in lids[i : i + n])
+
+
+def group_by_location(things, lids):
+    """
+    group Things expanded with their Locations by Location id. every id in
+    ``lids`` gets a (possibly empty) list
+    """
+    groups = {lid: [] for lid in lids}
+    for thing in things:
+        for loc in thing.get("Locations", []):
+            lid = loc["@iot.id"]
+            if lid in groups:
+                groups[lid].append(thing)
+    return groups
+
+
+def split_tag(tag):
+    """
+    split a tag like "Locations(1)/Things" into ("Things", "Locations(1)")
+    """
+    m = TAGREGEX.match(tag)
+    if m:
+        return m.group("entity"), m.group("scope")
+    return tag, None
+
+
+class IDCache:
+    """
+    name -> @iot.id resolution cache
+
+    keys are (base_url, entity, scope, name). an entry may also keep the
+    entity as last read or written, so an update can be diffed without
+    fetching it again. Holds at most ``maxsize`` entries, evicting the least
+    recently used, and entries older than ``ttl`` seconds are treated as
+    missing. Safe to share between threads.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        """
+        return (iotid, item), (None, None) when ``key`` is missing. item is
+        None unless it was stored with set
+        """
+        with self._lock:
+            try:
+                iotid, ts, item = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return None, None
+
+            if self.ttl is not None and time.monotonic() - ts > self.ttl:
+                del self._items[key]
+                self.expirations += 1
+                self.misses += 1
+                return None, None
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return iotid, item
+
+    def set(self, key, iotid, item=None):
+        with self._lock:
+            self._items[key] = (iotid, time.monotonic(), item)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def invalidate_iotid(self, base_url, entity, iotid):
+        iotid = str(iotid)
+        with self._lock:
+            for key in [
+                k
+                for k, (v, _, _) in self._items.items()
+                if k[0] == base_url and k[1] == entity and str(v) == iotid
+            ]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
+
+
+class PreloadIndex:
+    """
+    in-memory name index of collections pulled in bulk before a load
+
+    once a (base_url, entity, scope) collection is loaded the index is
+    authoritative for it: a name that is not in the index does not exist on
+    the server, so no lookup request is needed either way
+    """
+
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(v) for v in self._collections.values())
+
+    def load(self, base_url, entity, scope, items):
+        """
+        index ``items`` by name. like a lookup by name on the server the
+        first of duplicate names wins, so ``items`` should be in id order
+        """
+        names = {}
+        duplicates = set()
+        for item in items:
+            if "name" in item:
+                if item["name"] in names:
+                    duplicates.add(item["name"])
+                else:
+                    names[item["name"]] = item
+
+        if duplicates:
+            logging.warning(
+                f"duplicate {entity} names in {scope or base_url}, keeping the "
+                f"first of each: {sorted(duplicates)[:10]}"
+            )
+        with self._lock:
+            self._collections[(base_url, entity, scope)] = names
+        return len(names)
+
+    def is_loaded(self, base_url, entity, scope=None):
+        return (base_url, entity, scope) in self._collections
+
+    def lookup(self, key):
+        """
+        return (known, item). known is False if the collection of ``key`` has
+        not been loaded, item is None if the name is not in it
+        """
+        base_url, entity, scope, name = key
+        with self._lock:
+            names = self._collections.get((base_url, entity, scope))
+            if names is None:
+                return False, None
+            return True, names.get(name)
+
+    def add(self, key, item):
+        base_url, entity, scope, name = key
+        with self._lock:
+            names = self._collections.get((base_url, entity, scope))
+            if names is not None:
+                names[name] = item
+
+    def discard(self, key):
+        """
+        forget the entity of ``key``, e.g. after it was deleted on the server.
+        its collection stays loaded
+        """
+        base_url, entity, scope, name = key
+        with self._lock:
+            names = self._collections.get((base_url, entity, scope))
+            if names is not None:
+                names.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._collections.clear()
+
+
+# shared by every Client and STAClient that is not given its own cache
+default_id_cache = IDCache()
+
+
+def resolve_id_cache(id_cache):
+    """
+    None selects the process-wide cache, False disables caching
+    """
+    if id_cache is None:
+        return default_id_cache
+    elif id_cache is False:
+        return
+    return id_cache
+
+
+# ============= EOF =============================================
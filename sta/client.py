@@ -17,9 +17,27 @@ import os.path
 
 import click
 import yaml
-from requests import Session
-from jsonschema import validate, ValidationError
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+import itertools
 import re
+import threading
+
+from .cache import (
+    PreloadIndex,
+    group_by_location,
+    location_filter,
+    payload_scope,
+    resolve_id_cache,
+)
+from .diff import diff, link_expand, links
+from .graph import Graph, graph_spec
+from .jsonlib import iter_values, json_kwargs, response_json
+from .metrics import Metrics
+from .query import Query
+from .transport import make_session
+from .paging import PageStreamer, SkipRangeFetcher
+from .upload import ChunkUploader, make_sizer
 
 IDREGEX = re.compile(r"(?P<id>\(\d+\))")
 
@@ -32,34 +50,124 @@ def warning(msg):
     click.secho(msg, fg="red")
 
 
+class ValidationPolicy:
+    """
+    how often payloads are validated before they are sent
+
+    "strict" validates every payload, "off" none, and "sample" one in every
+    1 / ``sample_rate`` payloads of each entity type (always including the
+    first)
+    """
+
+    def __init__(self, mode="strict", sample_rate=0.01):
+        if mode not in ("strict", "sample", "off"):
+            raise ValueError(f"invalid validation mode {mode}")
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self._every = max(1, round(1 / sample_rate)) if sample_rate else 0
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def should_validate(self, klass):
+        if self.mode == "strict":
+            return True
+        elif self.mode == "off" or not self._every:
+            return False
+
+        with self._lock:
+            counter = self._counters.setdefault(klass, itertools.count())
+            return next(counter) % self._every == 0
+
+
+STRICT = ValidationPolicy()
+
+
 class BaseST:
     iotid = None
     _db_obj = None
+    # the fields sent by the last put/patch, empty when nothing had changed
+    changes = None
+    # set when the server answered 404 for the id of this entity
+    _stale = False
 
-    def __init__(self, payload, session, connection):
+    def __init__(
+        self,
+        payload,
+        session,
+        connection,
+        id_cache=None,
+        index=None,
+        validation=None,
+    ):
         self._payload = payload
         self._connection = connection
         self._session = session
+        self._id_cache = id_cache
+        self._index = index
+        self._validation = validation or STRICT
+
+    @classmethod
+    def _get_validator(cls):
+        # compiled once per class. looked up in the class __dict__ so a
+        # subclass with its own _schema gets its own validator
+        validator = cls.__dict__.get("_validator")
+        if validator is None:
+            klass = validator_for(cls._schema)
+            klass.check_schema(cls._schema)
+            validator = klass(cls._schema)
+            cls._validator = validator
+        return validator
+
+    @classmethod
+    def validate_many(cls, payloads):
+        """
+        validate ``payloads`` in one pass. returns a list of
+        (index, [error messages]) for every invalid payload
+        """
+        validator = cls._get_validator()
+        failures = []
+        for i, payload in enumerate(payloads):
+            errors = [e.message for e in validator.iter_errors(payload)]
+            if errors:
+                failures.append((i, errors))
+        return failures
 
     def _validate_payload(self):
-        try:
-            validate(instance=self._payload, schema=self._schema)
+        if not self._validation.should_validate(self.__class__):
             return True
-        except ValidationError as err:
-            print(
-                f"Validation failed for {self.__class__.__name__}. {err}. {self._payload}"
-            )
 
-    def _generate_request(
-        self, method, query=None, entity=None, orderby=None, expand=None, limit=None
-    ):
-        if orderby is None and method == "get":
-            orderby = "$orderby=id asc"
+        err = best_match(self._get_validator().iter_errors(self._payload))
+        if err is None:
+            return True
+
+        print(
+            f"Validation failed for {self.__class__.__name__}. {err}. {self._payload}"
+        )
 
+    def _base_url(self):
         base_url = self._connection["base_url"]
         if not base_url.startswith("http"):
             base_url = f"https://{base_url}/FROST-Server/v1.1"
+        return base_url
 
+    def _generate_request(
+        self,
+        method,
+        query=None,
+        entity=None,
+        orderby=None,
+        expand=None,
+        limit=None,
+        skip=None,
+        count=False,
+        spec=None,
+    ):
+        """
+        ``spec`` is a sta.query.Query. the other arguments are merged into a
+        copy of it: ``query`` is and-ed with its filter, ``expand`` is
+        appended to its expands and the rest override it
+        """
+        base_url = self._base_url()
         if entity is None:
             entity = self.__class__.__name__
 
@@ -67,24 +175,27 @@ class BaseST:
         if method == "patch":
             url = f"{url}({self.iotid})"
         else:
-            params = []
+            q = spec.copy() if spec is not None else Query()
+            q.add_filter(query)
+            if expand:
+                q.expand.append(expand)
             if limit:
-                params.append(f"$top={limit}")
+                q.top = limit
+            if skip:
+                q.skip = skip
+            if count:
+                q.count = True
 
             if orderby:
-                if not orderby.startswith("$orderby"):
-                    orderby = f"$orderby={orderby}"
-                params.append(orderby)
-
-            if query:
-                # params.append(urlencode({"$filter": query}))
-
-                params.append(f"$filter={query}")
+                if orderby.startswith("$orderby="):
+                    orderby = orderby[9:]
+                q.orderby = orderby
+            elif q.orderby is None and method == "get":
+                q.orderby = "id asc"
 
+            params = q.to_string()
             if params:
-                url = f"{url}?{'&'.join(params)}"
-            if expand:
-                url = f"{url}&$expand={expand}"
+                url = f"{url}?{params}"
 
         return {"method": method, "url": url}
 
@@ -93,7 +204,9 @@ class BaseST:
         func = getattr(self._session, request["method"])
         if not dry:
             resp = func(
-                request["url"], auth=(connection["user"], connection["pwd"]), **kw
+                request["url"],
+                auth=(connection["user"], connection["pwd"]),
+                **json_kwargs(kw),
             )
             if verbose:
                 if resp and resp.status_code not in (200, 201):
@@ -104,7 +217,7 @@ class BaseST:
     def _parse_response(self, request, resp, dry=False):
         if request["method"] == "get":
             if resp.status_code == 200:
-                return resp.json()
+                return response_json(resp)
         elif request["method"] == "post":
             if dry:
                 return True
@@ -119,6 +232,8 @@ class BaseST:
                 print(resp.status_code, resp.text)
 
         elif request["method"] == "patch":
+            if dry:
+                return True
             if resp.status_code == 200:
                 return True
 
@@ -131,73 +246,207 @@ class BaseST:
         limit=None,
         verbose=False,
         orderby=None,
+        prefetch=0,
+        workers=None,
+        page_size=1000,
+        ordered=True,
+        spec=None,
+        stream=False,
     ):
+        """
+        yield the entities of the collection
+
+        pages are fetched when needed. for bulk iteration ``prefetch`` pages
+        are downloaded ahead on a background thread
+
+        ``stream`` decodes each page incrementally and yields items while the
+        body is still being read, bounding memory to one item instead of one
+        page. it requires ijson and ignores ``workers`` and ``prefetch``
+        """
         if pages and pages < 0:
             pages = abs(pages)
             orderby = "$orderby=id desc"
 
-        def get_items(request, page_count, yielded):
-            if pages:
-                if page_count >= pages:
-                    return
+        def make_request(**kw):
+            return self._generate_request(
+                "get",
+                query=query,
+                entity=entity,
+                orderby=orderby,
+                expand=expand,
+                spec=spec,
+                **kw,
+            )
+
+        if stream:
+            start_request = make_request(limit=limit)
+            yield from self._get_stream(start_request["url"], pages, limit, verbose)
+            return
+
+        if workers and workers > 1:
+            items = self._get_parallel(
+                make_request, pages, limit, verbose, workers, page_size, ordered
+            )
+            if items is not None:
+                yield from items
+                return
 
+        def fetch(url, page_count):
             if verbose:
                 pv = ""
                 if pages:
-                    pv = "/{pages}"
+                    pv = f"/{pages}"
 
-                verbose_message(
-                    f"getting page={page_count + 1}{pv} - url={request['url']}"
-                )
-                # verbose_message("-------------- Request -----------------")
-                # verbose_message(request["url"])
-                # verbose_message("----------------------------------------")
-
-            resp = self._send_request(request)
-            resp = self._parse_response(request, resp)
-            if not resp:
-                click.secho(request["url"], fg="red")
-                return
+                verbose_message(f"getting page={page_count + 1}{pv} - url={url}")
 
-            if not resp["value"]:
-                warning("no records found")
-                return
-            else:
-                for v in resp["value"]:
+            return self._get_page(url)
+
+        start_request = make_request(limit=limit)
+        streamer = PageStreamer(fetch, start_request["url"], pages, prefetch)
+        yielded = 0
+        try:
+            for page in streamer:
+                if not page:
+                    return
+
+                if not page["value"]:
+                    warning("no records found")
+                    return
+
+                for v in page["value"]:
                     if limit and yielded >= limit:
                         return
 
                     yielded += 1
                     yield v
-                try:
-                    next_url = resp["@iot.nextLink"]
-                except KeyError:
+        finally:
+            streamer.close()
+
+    def _get_stream(self, url, pages, limit, verbose):
+        connection = self._connection
+        auth = (connection["user"], connection["pwd"])
+        page_count = 0
+        yielded = 0
+        while url:
+            if pages and page_count >= pages:
+                return
+
+            if verbose:
+                verbose_message(f"streaming page={page_count + 1} - url={url}")
+
+            meta = {}
+            resp = self._session.get(url, auth=auth, stream=True)
+            try:
+                if resp.status_code != 200:
+                    click.secho(url, fg="red")
                     return
 
-            yield from get_items(
-                {"method": "get", "url": next_url}, page_count + 1, yielded
-            )
+                resp.raw.decode_content = True
+                for v in iter_values(resp.raw, meta):
+                    if limit and yielded >= limit:
+                        return
+
+                    yielded += 1
+                    yield v
+            finally:
+                resp.close()
+
+            if not yielded:
+                warning("no records found")
+                return
+
+            url = meta.get("@iot.nextLink")
+            page_count += 1
 
-        start_request = self._generate_request(
-            "get",
-            query=query,
-            entity=entity,
-            orderby=orderby,
-            expand=expand,
-            limit=limit,
+    def _get_page(self, url):
+        request = {"method": "get", "url": url}
+        resp = self._send_request(request)
+        resp = self._parse_response(request, resp)
+        if not resp:
+            click.secho(url, fg="red")
+        return resp
+
+    def _get_parallel(
+        self, make_request, pages, limit, verbose, workers, page_size, ordered
+    ):
+        """
+        return a generator over the collection fetched as concurrent $skip/$top
+        windows, or None if the server did not report @iot.count
+        """
+        request = make_request(limit=1, count=True)
+        resp = self._parse_response(request, self._send_request(request))
+        if not resp or "@iot.count" not in resp:
+            if verbose:
+                warning(
+                    f"no @iot.count returned, paging serially. url={request['url']}"
+                )
+            return
+
+        total = resp["@iot.count"]
+        if limit:
+            total = min(total, limit)
+
+        if not total:
+            warning("no records found")
+            return iter(())
+
+        def make_url(skip, top):
+            return make_request(limit=top, skip=skip)["url"]
+
+        def fetch(url, window):
+            if verbose:
+                verbose_message(f"getting window={window + 1} - url={url}")
+            return self._get_page(url)
+
+        fetcher = SkipRangeFetcher(
+            fetch, make_url, total, page_size, workers, ordered, pages
         )
-        yield from get_items(start_request, 0, 0)
+
+        def items():
+            try:
+                for window in fetcher:
+                    yield from window
+            finally:
+                fetcher.close()
+
+        return items()
 
     def put(self, dry=False, check_exists=True):
+        """
+        create the entity, or PATCH the fields and links that differ from the
+        existing entity. nothing is sent when nothing changed
+        """
         if self._validate_payload():
             if check_exists and self.exists():
-                return self.patch()
-            else:
-                request = self._generate_request("post")
-                print(request)
-                resp = self._send_request(request, json=self._payload, dry=dry)
+                updated = self._update(dry)
+                if not self._stale:
+                    return updated
+
+                # the cached id was deleted on the server. look the name up
+                # again and create the entity if it is gone
+                if self._lookup():
+                    return self._update(dry)
 
-                return self._parse_response(request, resp, dry=dry)
+            request = self._generate_request("post")
+            print(request)
+            resp = self._send_request(request, json=self._payload, dry=dry)
+
+            added = self._parse_response(request, resp, dry=dry)
+            if added and not dry:
+                self._cache_iotid()
+            return added
+
+    def _update(self, dry=False):
+        existing = self._existing()
+        if self._stale:
+            return
+        if existing is None:
+            return self.patch(dry)
+
+        self.changes = diff(existing, self._payload)
+        if not self.changes:
+            return True
+        return self.patch(dry, self.changes)
 
     def getfirst(self, *args, **kw):
         try:
@@ -205,23 +454,175 @@ class BaseST:
         except StopIteration:
             return
 
-    def exists(self):
+    def _scope(self):
+        return payload_scope(self.__class__.__name__, self._payload)
+
+    def _exists_query(self):
+        """
+        return the (query, entity) used to look up this entity by name
+        """
         name = self._payload["name"]
-        resp = self.getfirst(f"name eq '{name}'")
-        if resp:
-            try:
-                self._db_obj = resp
-            except IndexError:
-                return
+        entity = None
+        scope = self._scope()
+        if scope:
+            entity = f"{scope}/{self.__class__.__name__}"
+        return f"name eq '{name}'", entity
+
+    def _cache_key(self):
+        return (
+            self._base_url(),
+            self.__class__.__name__,
+            self._scope(),
+            self._payload["name"],
+        )
+
+    def _local_exists(self):
+        """
+        answer exists() without a request. returns True or False when the
+        preload index or id cache knows the answer, None otherwise
+        """
+        key = self._cache_key()
+        if self._index is not None:
+            known, item = self._index.lookup(key)
+            if known:
+                if item is None:
+                    return False
+                self._db_obj = item
+                self.iotid = item["@iot.id"]
+                return True
 
+        if self._id_cache is not None:
+            iotid, item = self._id_cache.lookup(key)
+            if iotid is not None:
+                self.iotid = iotid
+                self._db_obj = item
+                return True
+
+    def _cache_iotid(self):
+        """
+        remember the id of this entity and what is known of it on the server,
+        the fetched entity or else the payload just written
+        """
+        if self.iotid is None:
+            return
+
+        item = self._db_obj
+        if item is None:
+            item = dict(self._payload, **{"@iot.id": self.iotid})
+
+        key = self._cache_key()
+        if self._id_cache is not None:
+            self._id_cache.set(key, self.iotid, item)
+        if self._index is not None:
+            self._index.add(key, item)
+
+    def _patched(self, payload):
+        """
+        apply a successful PATCH of ``payload`` to the known copy of this
+        entity
+        """
+        item = self._db_obj or {"@iot.id": self.iotid}
+        self._db_obj = dict(item, **payload)
+        if "name" in self._payload:
+            self._cache_iotid()
+
+    def _forget(self):
+        """
+        drop the cached id and copy of this entity after the server answered
+        404 for it
+        """
+        self._stale = True
+        if "name" in self._payload:
+            key = self._cache_key()
+            if self._id_cache is not None:
+                self._id_cache.invalidate(key)
+            if self._index is not None:
+                self._index.discard(key)
+        self.iotid = None
+        self._db_obj = None
+
+    def exists(self):
+        known = self._local_exists()
+        if known is not None:
+            return known
+        return self._lookup()
+
+    def _lookup(self):
+        """
+        look this entity up by name on the server
+        """
+        query, entity = self._exists_query()
+        resp = self.getfirst(query, entity=entity, expand=link_expand(self._payload))
+        return self._found(resp)
+
+    def _found(self, resp):
+        if resp:
+            self._db_obj = resp
             self.iotid = self._db_obj["@iot.id"]
+            self._cache_iotid()
             return True
 
-    def patch(self, dry=False):
+    def _existing(self):
+        """
+        the existing entity to diff the payload against, fetched again when
+        the known copy lacks the ids of a link in the payload
+        """
+        self._stale = False
+        existing = self._db_obj
+        if self._incomplete():
+            existing = self._fetch(link_expand(self._payload)) or existing
+        return existing
+
+    def _incomplete(self):
+        """
+        True if the known copy is missing or lacks a link of the payload
+        """
+        existing = self._db_obj
+        return existing is None or any(k not in existing for k in links(self._payload))
+
+    def _fetch(self, expand=None):
+        """
+        GET this entity by @iot.id, optionally with ``expand``
+        """
+        resp = self._send_request(self._fetch_request(expand), verbose=False)
+        return self._fetched(resp)
+
+    def _fetch_request(self, expand=None):
+        url = f"{self._base_url()}/{self.__class__.__name__}({self.iotid})"
+        if expand:
+            url = f"{url}?$expand={expand}"
+        return {"method": "get", "url": url}
+
+    def _fetched(self, resp):
+        if resp is not None:
+            if resp.status_code == 200:
+                self._db_obj = response_json(resp)
+                if "name" in self._payload:
+                    self._cache_iotid()
+                return self._db_obj
+            elif resp.status_code == 404:
+                self._forget()
+
+    def patch(self, dry=False, payload=None):
+        """
+        PATCH ``payload``, by default the whole payload
+        """
         if self._validate_payload():
+            if payload is None:
+                payload = self._payload
+            self.changes = payload
+
             request = self._generate_request("patch")
-            resp = self._send_request(request, json=self._payload, dry=dry)
-            return self._parse_response(request, resp, dry=dry)
+            resp = self._send_request(request, json=payload, dry=dry)
+            return self._patch_response(request, resp, payload, dry)
+
+    def _patch_response(self, request, resp, payload, dry=False):
+        patched = self._parse_response(request, resp, dry=dry)
+        if patched and not dry:
+            self._patched(payload)
+        elif resp is not None and resp.status_code == 404:
+            self._forget()
+        return patched
 
 
 class Things(BaseST):
@@ -239,21 +640,6 @@ class Things(BaseST):
         },
     }
 
-    def exists(self):
-        name = self._payload["name"]
-        location = self._payload["Locations"][0]
-        lid = location["@iot.id"]
-        resp = self.getfirst(f"name eq '{name}'", entity=f"Locations({lid})/Things")
-
-        if resp:
-            try:
-                self._db_obj = resp
-            except IndexError:
-                return
-
-            self.iotid = self._db_obj["@iot.id"]
-            return True
-
 
 class Locations(BaseST):
     _schema = {
@@ -384,21 +770,6 @@ class Datastreams(BaseST):
         ],
     }
 
-    def exists(self):
-        name = self._payload["name"]
-        thing = self._payload["Thing"]
-        lid = thing["@iot.id"]
-        resp = self.getfirst(f"name eq '{name}'", entity=f"Things({lid})/Datastreams")
-
-        if resp:
-            try:
-                self._db_obj = resp
-            except IndexError:
-                return
-
-            self.iotid = self._db_obj["@iot.id"]
-            return True
-
 
 class Observations(BaseST):
     _schema = {
@@ -432,121 +803,363 @@ class ObservationsArray(BaseST):
         },
     }
 
-    def put(self, dry=False):
+    results = None
+    sizer = None
+
+    def put(
+        self,
+        dry=False,
+        workers=4,
+        max_in_flight=None,
+        chunk_size=None,
+        sizer=None,
+        result_type=None,
+        columns=None,
+    ):
+        """
+        upload the observations as CreateObservations chunks on a pool of
+        ``workers`` threads. returns a list of ChunkResult, one per chunk
+
+        chunks are sized adaptively unless a fixed ``chunk_size`` or a
+        configured ChunkSizer is given
+
+        observations may also be columnar (NumPy structured array, dict of
+        arrays or DataFrame), see sta.columnar.to_data_array for
+        ``result_type`` and ``columns``
+        """
+        self._load_columns(result_type, columns)
         if self._validate_payload():
+            request = self._create_request()
             obs = self._payload["observations"]
-            n = 100
             nobs = len(obs)
-            for i in range(0, nobs, n):
-                print("loading chunk {}/{}".format(i, nobs))
-                chunk = obs[i : i + n]
 
-                pd = [
-                    {
-                        "Datastream": self._payload["Datastream"],
-                        "components": self._payload["components"],
-                        "dataArray": chunk,
-                    }
-                ]
-                base_url = self._connection["base_url"]
-                if not base_url.startswith("http"):
-                    base_url = f"https://{base_url}/FROST-Server/v1.1"
+            def post(pd):
+                return self._send_request(request, json=pd, dry=dry, verbose=False)
+
+            def on_result(result):
+                if result.ok:
+                    print(f"loaded chunk {result.start}/{nobs} nrows={result.nrows}")
+                else:
+                    warning(
+                        f"failed loading chunk {result.start}/{nobs}. {result.error}"
+                    )
+
+            self.sizer = make_sizer(chunk_size, sizer)
+            uploader = ChunkUploader(
+                post,
+                workers,
+                max_in_flight,
+                on_result,
+                sizer=self.sizer,
+                metrics=getattr(self._session, "metrics", None),
+            )
+            self.results = uploader.upload(obs, self._make_chunk_payload)
+            verbose_message(f"chunk sizes {self.sizer.report()}")
+            return self.results
+
+    def _load_columns(self, result_type=None, columns=None):
+        obs = self._payload["observations"]
+        if not isinstance(obs, list):
+            from .columnar import to_data_array
+
+            rows = to_data_array(obs, self._payload["components"], result_type, columns)
+            self._payload = dict(self._payload, observations=rows)
+
+    def _create_request(self):
+        return {"method": "post", "url": f"{self._base_url()}/CreateObservations"}
+
+    def _make_chunk_payload(self, chunk):
+        return [
+            {
+                "Datastream": self._payload["Datastream"],
+                "components": self._payload["components"],
+                "dataArray": chunk,
+            }
+        ]
+
+    def _chunks(self, n=100):
+        obs = self._payload["observations"]
+        for i in range(0, len(obs), n):
+            chunk = obs[i : i + n]
+            yield i, len(chunk), self._make_chunk_payload(chunk)
+
+
+def load_connection(base_url=None, user=None, pwd=None):
+    connection = {"base_url": base_url, "user": user, "pwd": pwd}
+    if not base_url:
+        p = os.path.join(os.path.expanduser("~"), ".sta.yaml")
+        if os.path.isfile(p):
+            with open(p, "r") as rfile:
+                obj = yaml.load(rfile, Loader=yaml.SafeLoader)
+                connection.update(**obj)
+
+    if not connection["base_url"]:
+        base_url = input("Please enter a base url for a SensorThings instance>> ")
+        if base_url.endswith("/"):
+            base_url = base_url[:-1]
+        connection["base_url"] = base_url
+        with open(p, "w") as wfile:
+            yaml.dump(connection, wfile)
+    return connection
 
-                url = f"{base_url}/CreateObservations"
-                request = {"method": "post", "url": url}
-                resp = self._send_request(request, json=pd, dry=dry)
 
-                self._parse_response(request, resp, dry=dry)
+class Client:
+    def __init__(
+        self,
+        base_url=None,
+        user=None,
+        pwd=None,
+        id_cache=None,
+        validation="strict",
+        sample_rate=0.01,
+        session=None,
+        metrics=None,
+        **transport,
+    ):
+        """
+        ``id_cache`` is an IDCache for name -> @iot.id lookups. None uses the
+        process-wide cache, False disables caching
+
+        ``validation`` is "strict", "sample" or "off", see ValidationPolicy
+
+        requests go through ``session``, by default a pooled keep-alive
+        session with retries built by sta.transport.make_session from the
+        ``transport`` keywords (pool_size, retries, backoff, retry_statuses,
+        retry_methods, connect_timeout, read_timeout, gzip). use a pool_size
+        of at least the ``workers`` given to get/put
+
+        requests, uploads and id cache hits are recorded in ``metrics``, a
+        sta.metrics.Metrics created when None. a custom ``session`` records
+        requests only if it has a ``metrics`` attribute
+        """
+        self._connection = load_connection(base_url, user, pwd)
+        self._validation = ValidationPolicy(validation, sample_rate)
+        self._id_cache = resolve_id_cache(id_cache)
+        self._index = PreloadIndex()
+        if metrics is None:
+            metrics = Metrics()
+        metrics.add_cache("id_cache", self._id_cache)
+        self._metrics = metrics
+        if session is None:
+            session = make_session(metrics=metrics, **transport)
+        self._session = session
 
+    @property
+    def session(self):
+        return self._session
 
-class Client:
-    def __init__(self, base_url=None, user=None, pwd=None):
-        self._connection = {"base_url": base_url, "user": user, "pwd": pwd}
-        if not base_url:
-            p = os.path.join(os.path.expanduser("~"), ".sta.yaml")
-            if os.path.isfile(p):
-                with open(p, "r") as rfile:
-                    obj = yaml.load(rfile, Loader=yaml.SafeLoader)
-                    self._connection.update(**obj)
-
-        if not self._connection["base_url"]:
-            base_url = input("Please enter a base url for a SensorThings instance>> ")
-            if base_url.endswith("/"):
-                base_url = base_url[:-1]
-            self._connection["base_url"] = base_url
-            with open(p, "w") as wfile:
-                yaml.dump(self._connection, wfile)
-
-        self._session = Session()
+    @property
+    def metrics(self):
+        return self._metrics
 
     @property
     def base_url(self):
         return self._connection["base_url"]
 
+    @property
+    def id_cache(self):
+        return self._id_cache
+
+    @property
+    def index(self):
+        return self._index
+
+    def _entity(self, klass, payload=None):
+        return klass(
+            payload,
+            self._session,
+            self._connection,
+            self._id_cache,
+            self._index,
+            self._validation,
+        )
+
+    def batch(self, size=100, check_exists=True, dry=False, verbose=False):
+        """
+        return a Batch that queues put_*/patch_location calls and sends them
+        as OData JSON $batch requests of ``size`` operations
+
+        with client.batch() as b:
+            thing = b.put_thing(payload)
+            b.put_datastream({..., "Thing": {"@iot.id": thing}})
+        """
+        from .batch import Batch
+
+        return Batch(
+            self, size=size, check_exists=check_exists, dry=dry, verbose=verbose
+        )
+
+    def preload(
+        self,
+        sensors=True,
+        observed_properties=True,
+        locations=None,
+        datastreams=False,
+        verbose=False,
+    ):
+        """
+        pull reference entities into the preload index so that exists() on
+        them is answered without a request
+
+        ``locations`` is an iterable of Location ids or dicts whose Things are
+        loaded. with ``datastreams`` the Datastreams of those Things are
+        loaded too. returns the number of entities indexed per entity type
+        """
+        index = self._index
+        base_url = self._entity(Sensors)._base_url()
+        counts = {}
+        if sensors:
+            items = self.get_sensors(verbose=verbose, workers=4)
+            counts["Sensors"] = index.load(base_url, "Sensors", None, items)
+
+        if observed_properties:
+            items = self.get_observed_properties(verbose=verbose, workers=4)
+            counts["ObservedProperties"] = index.load(
+                base_url, "ObservedProperties", None, items
+            )
+
+        if locations:
+            lids = [l["@iot.id"] if isinstance(l, dict) else l for l in locations]
+            expand = "Locations($select=id)"
+            if datastreams:
+                # with the ids of their links so a put can diff them
+                expand = (
+                    f"{expand},Datastreams($expand=Thing($select=id),"
+                    f"Sensor($select=id),ObservedProperty($select=id))"
+                )
+
+            things = []
+            for query in location_filter(lids):
+                things.extend(self.get_things(query, expand=expand, verbose=verbose))
+
+            counts["Things"] = 0
+            for lid, group in group_by_location(things, lids).items():
+                counts["Things"] += index.load(
+                    base_url, "Things", f"Locations({lid})", group
+                )
+
+            if datastreams:
+                counts["Datastreams"] = 0
+                for thing in things:
+                    items = self._get_nested(thing, "Datastreams")
+                    counts["Datastreams"] += index.load(
+                        base_url, "Datastreams", f"Things({thing['@iot.id']})", items
+                    )
+
+        if verbose:
+            verbose_message(f"preloaded {counts}")
+        return counts
+
+    def _get_nested(self, item, nav):
+        """
+        return the expanded ``nav`` collection of ``item``, following the
+        collection's own nextLink when the server truncated it
+        """
+        values = list(item.get(nav, []))
+        url = item.get(f"{nav}@iot.nextLink")
+        if url:
+            entity = self._entity(Things)
+            for page in PageStreamer(lambda u, i: entity._get_page(u), url):
+                if not page:
+                    break
+                values.extend(page["value"])
+        return values
+
+    def get_graph(self, query=None, selects=None, spec=None, verbose=False, **kw):
+        """
+        fetch Locations with their Things and the Things' Datastreams in one
+        paged request ($expand=Things($expand=Datastreams)) and return a
+        sta.graph.Graph
+
+        ``query`` filters the Locations and ``selects`` maps an entity name
+        onto its $select. include "id" in each select, the graph is indexed
+        by @iot.id. nested collections truncated by the server are completed
+        through their own nextLinks
+        """
+        spec = graph_spec(selects, spec)
+        ds_spec = Query(select=(selects or {}).get("Datastreams"))
+
+        def get_children(item, nav):
+            if nav in item or f"{nav}@iot.nextLink" in item:
+                return self._get_nested(item, nav)
+
+            # the pages behind a nested nextLink may not repeat the
+            # deeper $expand
+            entity = f"Things({item['@iot.id']})/{nav}"
+            return self.get_datastreams(entity=entity, spec=ds_spec)
+
+        graph = Graph()
+        for location in self.get_locations(query, spec=spec, verbose=verbose, **kw):
+            graph.add(location, get_children)
+
+        if verbose:
+            verbose_message(f"fetched {graph}")
+        return graph
+
     def locations(self):
-        loc = Locations(None, self._session, self._connection)
+        loc = self._entity(Locations)
         return loc.get(None, verbose=True)
 
     def put_sensor(self, payload, dry=False):
-        sensor = Sensors(payload, self._session, self._connection)
+        sensor = self._entity(Sensors, payload)
         sensor.put(dry)
         return sensor
 
     def put_observed_property(self, payload, dry=False):
-        obs = ObservedProperties(payload, self._session, self._connection)
+        obs = self._entity(ObservedProperties, payload)
         obs.put(dry)
         return obs
 
     def put_datastream(self, payload, dry=False):
-        datastream = Datastreams(payload, self._session, self._connection)
+        datastream = self._entity(Datastreams, payload)
         datastream.put(dry)
         return datastream
 
     def put_location(self, payload, dry=False):
-        location = Locations(payload, self._session, self._connection)
+        location = self._entity(Locations, payload)
         location.put(dry)
         return location
 
     def put_thing(self, payload, dry=False):
-        thing = Things(payload, self._session, self._connection)
+        thing = self._entity(Things, payload)
         thing.put(dry)
         return thing
 
-    def add_observations(self, payload, dry=False):
-        obs = ObservationsArray(payload, self._session, self._connection)
-        obs.put(dry)
+    def add_observations(self, payload, dry=False, **kw):
+        obs = self._entity(ObservationsArray, payload)
+        obs.put(dry, **kw)
         return obs
 
     def add_observation(self, payload, dry=False):
-        obs = Observations(payload, self._session, self._connection)
+        obs = self._entity(Observations, payload)
         obs.put(dry, check_exists=False)
         return obs
 
     def patch_location(self, iotid, payload, dry=False):
-        location = Locations(payload, self._session, self._connection)
+        location = self._entity(Locations, payload)
         location.iotid = iotid
         location.patch(dry)
         return location
 
-    def get_sensors(self, query=None, name=None):
+    def get_sensors(self, query=None, name=None, **kw):
         if name is not None:
             query = f"name eq '{name}'"
 
-        yield from Sensors(None, self._session, self._connection).get(query)
+        yield from self._entity(Sensors).get(query, **kw)
 
-    def get_observed_properties(self, query=None, name=None):
+    def get_observed_properties(self, query=None, name=None, **kw):
         if name is not None:
             query = f"name eq '{name}'"
-        yield from ObservedProperties(None, self._session, self._connection).get(query)
+        yield from self._entity(ObservedProperties).get(query, **kw)
 
     def get_datastreams(self, query=None, **kw):
-        yield from Datastreams(None, self._session, self._connection).get(query, **kw)
+        yield from self._entity(Datastreams).get(query, **kw)
 
     def get_locations(self, query=None, **kw):
-        yield from Locations(None, self._session, self._connection).get(query, **kw)
+        yield from self._entity(Locations).get(query, **kw)
 
     def get_things(self, query=None, **kw):
-        yield from Things(None, self._session, self._connection).get(query, **kw)
+        yield from self._entity(Things).get(query, **kw)
 
     def get_location(self, query=None, name=None, **kw):
         if name is not None:
@@ -556,7 +1169,7 @@ class Client:
         except StopIteration:
             pass
 
-    def get_thing(self, query=None, name=None, location=None):
+    def get_thing(self, query=None, name=None, location=None, **kw):
         entity = None
         if location:
             if isinstance(location, dict):
@@ -565,9 +1178,9 @@ class Client:
         if name is not None:
             query = f"name eq '{name}'"
 
-        return next(self.get_things(query, entity=entity))
+        return next(self.get_things(query, entity=entity, **kw))
 
-    def get_datastream(self, query=None, name=None, thing=None):
+    def get_datastream(self, query=None, name=None, thing=None, **kw):
         entity = None
         if thing:
             if isinstance(thing, dict):
@@ -576,22 +1189,96 @@ class Client:
         if name is not None:
             query = f"name eq '{name}'"
 
-        return next(self.get_datastreams(query, entity=entity))
+        return next(self.get_datastreams(query, entity=entity, **kw))
 
     def get_observations(self, datastream, **kw):
         if isinstance(datastream, dict):
             datastream = datastream["@iot.id"]
         entity = f"Datastreams({datastream})/Observations"
 
-        yield from Datastreams(None, self._session, self._connection).get(
-            None, entity=entity, **kw
+        yield from self._entity(Datastreams).get(None, entity=entity, **kw)
+
+    def get_observations_columnar(
+        self,
+        datastream,
+        start=None,
+        end=None,
+        result_type="double",
+        as_arrow=False,
+        limit=10000,
+        prefetch=0,
+        verbose=False,
+    ):
+        """
+        return the phenomenonTime and result of a datastream's Observations
+        as NumPy arrays, {"phenomenonTime": datetime64[ms], "result": ...},
+        or as a pyarrow Table with ``as_arrow``
+
+        only those two fields are requested ($select) and FROST's
+        $resultFormat=dataArray is used when the server supports it. pages are
+        copied into buffers preallocated from @iot.count. ``start`` and
+        ``end`` bound phenomenonTime (start inclusive, end exclusive)
+        """
+        from .columnar import (
+            NUMPY_CASTS,
+            ColumnBuffer,
+            page_columns,
+            parse_times,
+            result_array,
+        )
+
+        if isinstance(datastream, dict):
+            datastream = datastream["@iot.id"]
+
+        obs = self._entity(Observations)
+        components = ["phenomenonTime", "result"]
+        q = Query(
+            select=components, orderby="phenomenonTime asc", top=limit, count=True
         )
+        if start:
+            q.add_filter(f"phenomenonTime ge {start}")
+        if end:
+            q.add_filter(f"phenomenonTime lt {end}")
+
+        base = f"{obs._base_url()}/Datastreams({datastream})/Observations"
+        url = f"{base}?{q.to_string()}"
+        q.result_format = "dataArray"
+        request = {"method": "get", "url": f"{base}?{q.to_string()}"}
+        first = obs._parse_response(request, obs._send_request(request, verbose=False))
+        if first is None:
+            # server without dataArray support
+            first = obs._get_page(url)
+            if first is None:
+                return
+
+        count = first.get("@iot.count", 0)
+        times = ColumnBuffer("datetime64[ms]", count)
+        results = ColumnBuffer(NUMPY_CASTS[result_type], count)
+
+        def fetch(url, page_count):
+            if page_count == 0:
+                return first
+            if verbose:
+                verbose_message(f"getting page={page_count + 1} - url={url}")
+            return obs._get_page(url)
+
+        for page in PageStreamer(fetch, request["url"], prefetch=prefetch):
+            if not page:
+                break
+            ts, rs = page_columns(page, components)
+            times.extend(parse_times(ts))
+            results.extend(result_array(rs, result_type))
+
+        columns = {"phenomenonTime": times.array, "result": results.array}
+        if as_arrow:
+            import pyarrow
+
+            return pyarrow.table(columns)
+        return columns
 
     def get_observation(self, ptime, result, **kw):
         query = f"phenomenonTime eq {ptime} and result eq {result}"
-        gen = Observations(None, self._session, self._connection).get(
-            query, entity="Observations", **kw
-        )
+        gen = self._entity(Observations).get(query, entity="Observations", **kw)
         try:
             return next(gen)
         except StopIteration:
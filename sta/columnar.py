@@ -0,0 +1,246 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import numpy as np
+
+from .definitions import CASTS
+from .util import statimes
+
+TIME_COMPONENTS = ("phenomenonTime", "resultTime")
+
+# column names tried when a component has no column of the same name
+ALIASES = {
+    "phenomenonTime": ("time", "timestamp", "datetime"),
+    "resultTime": ("time", "timestamp", "datetime"),
+    "result": ("value",),
+}
+
+NUMPY_CASTS = {
+    "double": np.float64,
+    "integer": np.int64,
+    "boolean": np.bool_,
+    "uri": np.str_,
+    "any": np.str_,
+}
+
+
+def _isnull(v):
+    if v is None:
+        return True
+    try:
+        return bool(v != v)
+    except (TypeError, ValueError):
+        # pandas.NA has no truth value
+        return True
+
+
+def null_mask(arr):
+    """
+    True where ``arr`` holds None, NaN, NaT or pandas.NA
+    """
+    arr = np.asarray(arr)
+    if arr.dtype == object:
+        return np.fromiter((_isnull(v) for v in arr), dtype=bool, count=len(arr))
+    elif arr.dtype.kind in "fc":
+        return np.isnan(arr)
+    elif arr.dtype.kind in "mM":
+        return np.isnat(arr)
+    return np.zeros(len(arr), dtype=bool)
+
+
+def infer_result_type(arr):
+    """
+    map the dtype of the non-null values of a result column onto a key of
+    definitions.CASTS
+    """
+    arr = np.asarray(arr)
+    if arr.dtype == object:
+        # e.g. a list holding None or a pandas nullable column
+        arr = np.asarray(arr[~null_mask(arr)].tolist())
+    if np.issubdtype(arr.dtype, np.bool_):
+        return "boolean"
+    elif np.issubdtype(arr.dtype, np.integer):
+        return "integer"
+    elif np.issubdtype(arr.dtype, np.floating):
+        return "double"
+    return "any"
+
+
+def _column_names(data):
+    if isinstance(data, dict):
+        return list(data.keys())
+    elif isinstance(data, np.ndarray):
+        return list(data.dtype.names)
+    return list(data.columns)
+
+
+def _get_column(data, name):
+    if isinstance(data, dict):
+        return np.asarray(data[name])
+    elif isinstance(data, np.ndarray):
+        return data[name]
+
+    series = data[name]
+    if getattr(series.dtype, "tz", None) is not None:
+        # timezone aware pandas column, normalize to naive UTC
+        series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+    elif not isinstance(series.dtype, np.dtype):
+        # a nullable extension column such as Int64 or boolean. keep its
+        # values and turn pandas.NA into None instead of a float NaN
+        return series.to_numpy(dtype=object, na_value=None)
+    return series.to_numpy()
+
+
+def _resolve_column(component, names, columns):
+    if columns and component in columns:
+        return columns[component]
+    if component in names:
+        return component
+    for alias in ALIASES.get(component, ()):
+        if alias in names:
+            return alias
+    raise KeyError(f"no column for component {component}. columns={names}")
+
+
+def _result_list(arr, result_type):
+    if result_type is None:
+        result_type = infer_result_type(arr)
+
+    if result_type not in CASTS:
+        raise ValueError(f"invalid result_type {result_type}. use one of {list(CASTS)}")
+
+    arr = np.asarray(arr)
+    null = null_mask(arr)
+    values = arr[~null] if null.any() else arr
+    if result_type == "integer":
+        if arr.dtype.kind in "fc" and null.any():
+            raise ValueError("cannot cast NaN results to integer")
+        if values.dtype.kind in "fcO" and len(values):
+            f = values.astype(np.float64)
+            if not np.array_equal(f, np.trunc(f)):
+                raise ValueError("cannot cast non-integral results to integer")
+
+    values = values.astype(NUMPY_CASTS[result_type]).tolist()
+    if not null.any():
+        return values
+
+    # nulls are sent as JSON null
+    out = [None] * len(arr)
+    for i, v in zip(np.flatnonzero(~null), values):
+        out[i] = v
+    return out
+
+
+def to_data_array(data, components, result_type=None, columns=None):
+    """
+    convert column oriented observations into the rows of a CreateObservations
+    dataArray
+
+    ``data`` is a NumPy structured array, a dict of arrays or a pandas
+    DataFrame with one column per component. ``columns`` maps components onto
+    column names that differ from the component name. time components are
+    normalized with sta.util.statimes and the result column is cast with the
+    dtype of ``result_type`` (a key of definitions.CASTS, inferred from the
+    non-null values when None). null results are sent as JSON null; NaN or
+    fractional values raise ValueError for an integer ``result_type``. a
+    list of rows is returned unchanged
+    """
+    if isinstance(data, list):
+        return data
+
+    names = _column_names(data)
+    cols = []
+    for component in components:
+        arr = _get_column(data, _resolve_column(component, names, columns))
+        if component in TIME_COMPONENTS:
+            cols.append(statimes(arr))
+        elif component == "result":
+            cols.append(_result_list(arr, result_type))
+        else:
+            cols.append(np.asarray(arr).tolist())
+
+    return list(map(list, zip(*cols)))
+
+
+class ColumnBuffer:
+    """
+    preallocated NumPy buffer filled page by page. ``capacity`` is usually the
+    @iot.count of the query, the buffer doubles if it turns out too small
+    """
+
+    def __init__(self, dtype, capacity=0):
+        self._arr = np.empty(max(capacity, 0), dtype=dtype)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def extend(self, values):
+        n = len(values)
+        end = self._n + n
+        if end > len(self._arr):
+            arr = np.empty(max(end, 2 * len(self._arr)), dtype=self._arr.dtype)
+            arr[: self._n] = self._arr[: self._n]
+            self._arr = arr
+        self._arr[self._n : end] = values
+        self._n = end
+
+    @property
+    def array(self):
+        return self._arr[: self._n]
+
+
+def parse_times(tss):
+    """
+    parse ISO-8601 "Z" strings (or the start of "start/end" intervals) into a
+    datetime64[ms] array
+    """
+    tss = [t.split("/", 1)[0].rstrip("Z") if t else "NaT" for t in tss]
+    return np.array(tss, dtype="datetime64[ms]")
+
+
+def result_array(values, result_type):
+    """
+    convert a list of results into an array of the dtype of ``result_type``.
+    nulls become NaN for doubles
+    """
+    dtype = NUMPY_CASTS[result_type]
+    if result_type == "double":
+        return np.array(values, dtype=dtype)
+    return np.array(values).astype(dtype)
+
+
+def page_columns(page, components):
+    """
+    return one list per component from a page of Observations, either in
+    $resultFormat=dataArray form or as plain entity dicts
+    """
+    values = page.get("value", [])
+    if values and "dataArray" in values[0]:
+        cols = [[] for _ in components]
+        for block in values:
+            rows = block["dataArray"]
+            if not rows:
+                continue
+
+            transposed = list(zip(*rows))
+            for col, c in zip(cols, components):
+                col.extend(transposed[block["components"].index(c)])
+        return cols
+
+    return [[v.get(c) for v in values] for c in components]
+
+
+# ============= EOF =============================================
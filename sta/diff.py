@@ -0,0 +1,125 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+change detection between a server entity and a new payload
+
+plain fields are compared by content. navigation properties (capitalized
+keys such as "Thing" or "Locations") are compared by the ids they link to
+when the payload holds {"@iot.id": ...} references, so the existing entity
+must carry them too, e.g. fetched with $expand=Thing($select=id) (see
+link_expand). nested entities (deep inserts) and annotations ("@iot.id",
+"Things@iot.navigationLink") are never part of a PATCH body
+"""
+
+import json
+
+
+def writable(payload):
+    """
+    the plain fields of ``payload``
+    """
+    return {k: v for k, v in payload.items() if k[:1].islower()}
+
+
+def _ref_ids(value):
+    """
+    the ids of a {"@iot.id": x} reference or a list of them, None for
+    anything else
+    """
+    if isinstance(value, dict):
+        if "@iot.id" in value:
+            return {str(value["@iot.id"])}
+    elif isinstance(value, (list, tuple)):
+        ids = set()
+        for v in value:
+            if not isinstance(v, dict) or "@iot.id" not in v:
+                return
+            ids.add(str(v["@iot.id"]))
+        return ids
+
+
+def links(payload):
+    """
+    the navigation properties of ``payload`` that reference entities by id,
+    as {key: set of ids}
+    """
+    out = {}
+    for k, v in payload.items():
+        if k[:1].isupper() and "@" not in k:
+            ids = _ref_ids(v)
+            if ids is not None:
+                out[k] = ids
+    return out
+
+
+def link_expand(payload):
+    """
+    the $expand expression fetching just the ids of the links of
+    ``payload``, e.g. "Sensor($select=id),Thing($select=id)". None when it
+    has no links
+    """
+    keys = sorted(links(payload))
+    if keys:
+        return ",".join(f"{k}($select=id)" for k in keys)
+
+
+def _normalize(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, float) and value.is_integer():
+        # the server may echo 34.0 as 34
+        return int(value)
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def canonical(value):
+    """
+    a JSON string equal for equal content regardless of key order,
+    tuple vs list and 1.0 vs 1
+    """
+    return json.dumps(
+        _normalize(value), sort_keys=True, separators=(",", ":"), default=str
+    )
+
+
+def diff(existing, payload, fields=None):
+    """
+    the minimal PATCH body turning ``existing`` into ``payload``: the plain
+    fields of ``payload`` whose content differs from ``existing`` and the
+    links pointing to other ids, limited to ``fields``. a field or link
+    missing from ``existing`` counts as changed. an empty dict means there
+    is nothing to PATCH
+    """
+    changes = {}
+    for k, v in writable(payload).items():
+        if fields is not None and k not in fields:
+            continue
+        if k not in existing or canonical(existing[k]) != canonical(v):
+            changes[k] = v
+
+    for k, ids in links(payload).items():
+        if fields is not None and k not in fields:
+            continue
+        if _ref_ids(existing.get(k)) != ids:
+            changes[k] = payload[k]
+    return changes
+
+
+# ============= EOF =============================================
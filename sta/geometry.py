@@ -0,0 +1,109 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import threading
+
+import pyproj
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# pyproj Transformers must not be shared between threads
+_local = threading.local()
+
+
+def crs_key(zone=None, srid=None, ellps=None):
+    """
+    the cache key of the CRS of a point. a UTM ``zone`` takes precedence over
+    ``srid``, as in make_geometry_point_from_utm
+    """
+    if zone:
+        return "utm", int(zone), ellps or "WGS84"
+    elif srid:
+        return "epsg", int(srid), None
+    raise ValueError("need a utm zone or an srid")
+
+
+def get_transformer(key):
+    """
+    return the cached Transformer from the CRS of ``key`` (see crs_key) to
+    its geographic CRS, with lon/lat axis order
+    """
+    cache = getattr(_local, "transformers", None)
+    if cache is None:
+        cache = _local.transformers = {}
+
+    transformer = cache.get(key)
+    if transformer is None:
+        kind, value, ellps = key
+        if kind == "utm":
+            crs = pyproj.CRS.from_dict({"proj": "utm", "zone": value, "ellps": ellps})
+        else:
+            crs = pyproj.CRS.from_epsg(value)
+        transformer = cache[key] = pyproj.Transformer.from_crs(
+            crs, crs.geodetic_crs, always_xy=True
+        )
+    return transformer
+
+
+def _column(values, n):
+    # a scalar, including a NumPy scalar from an array row, applies to every
+    # point
+    if isinstance(values, str) or not hasattr(values, "__len__"):
+        return [values] * n
+    if len(values) != n:
+        raise ValueError(f"expected {n} values, got {len(values)}")
+    return values
+
+
+def _take(values, idx):
+    if np is not None:
+        return np.asarray(values, dtype=float)[idx]
+    return [float(values[i]) for i in idx]
+
+
+def points_from_utm(eastings, northings, zones=None, srids=None, ellps=None):
+    """
+    convert projected coordinates to GeoJSON Point dicts
+
+    ``zones`` and ``srids`` are a value per point or one value for all
+    points. the points are grouped by CRS and each group is transformed in
+    one vectorized call through a cached Transformer. returns the Points in
+    input order
+    """
+    n = len(eastings)
+    if len(northings) != n:
+        raise ValueError("eastings and northings differ in length")
+
+    zones = _column(zones, n)
+    srids = _column(srids, n)
+
+    groups = {}
+    for i, (zone, srid) in enumerate(zip(zones, srids)):
+        groups.setdefault(crs_key(zone, srid, ellps), []).append(i)
+
+    points = [None] * n
+    for key, idx in groups.items():
+        xs = _take(eastings, idx)
+        ys = _take(northings, idx)
+        lons, lats = get_transformer(key).transform(xs, ys)
+        for i, lon, lat in zip(idx, lons, lats):
+            points[i] = {"type": "Point", "coordinates": [float(lon), float(lat)]}
+    return points
+
+
+# ============= EOF =============================================
@@ -0,0 +1,165 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from .query import Query, Expand
+
+# navigation path of the inventory graph, parent to child
+LEVELS = ("Locations", "Things", "Datastreams")
+
+
+class Node:
+    """
+    an entity of the graph. ``item`` is the entity dict without its expanded
+    collections, ``children`` maps a navigation property onto a NodeIndex
+    """
+
+    def __init__(self, entity, item, parent=None):
+        self.entity = entity
+        self.item = item
+        self.parent = parent
+        self.children = {}
+
+    def __repr__(self):
+        return f"<{self.entity} {self.iotid} {self.name}>"
+
+    def __getitem__(self, key):
+        return self.item[key]
+
+    def get(self, key, default=None):
+        return self.item.get(key, default)
+
+    @property
+    def iotid(self):
+        return self.item.get("@iot.id")
+
+    @property
+    def name(self):
+        return self.item.get("name")
+
+    @property
+    def things(self):
+        return self.children.get("Things", NodeIndex())
+
+    @property
+    def datastreams(self):
+        return self.children.get("Datastreams", NodeIndex())
+
+
+class NodeIndex:
+    """
+    nodes in fetch order with lookups by @iot.id and by name. names are not
+    unique in SensorThings so ``named`` returns a list
+    """
+
+    def __init__(self):
+        self._nodes = []
+        self._ids = {}
+        self._names = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __contains__(self, iotid):
+        return iotid in self._ids
+
+    def add(self, node):
+        self._nodes.append(node)
+        self._ids[node.iotid] = node
+        self._names.setdefault(node.name, []).append(node)
+
+    def get(self, iotid, default=None):
+        return self._ids.get(iotid, default)
+
+    def named(self, name):
+        return list(self._names.get(name, []))
+
+    def first(self, name):
+        nodes = self._names.get(name)
+        if nodes:
+            return nodes[0]
+
+
+class Graph:
+    """
+    Locations -> Things -> Datastreams. each level has a global NodeIndex
+    (``locations``, ``things``, ``datastreams``) and every node indexes its
+    own children. a Thing linked to several Locations is a single node
+    listed under each of them
+    """
+
+    def __init__(self):
+        self.indexes = {entity: NodeIndex() for entity in LEVELS}
+
+    def __repr__(self):
+        counts = ", ".join(f"{k}={len(v)}" for k, v in self.indexes.items())
+        return f"<Graph {counts}>"
+
+    @property
+    def locations(self):
+        return self.indexes["Locations"]
+
+    @property
+    def things(self):
+        return self.indexes["Things"]
+
+    @property
+    def datastreams(self):
+        return self.indexes["Datastreams"]
+
+    def add(self, item, get_children, level=0, parent=None):
+        """
+        add ``item`` at ``level`` and recurse into its expanded collection.
+        ``get_children(item, nav)`` returns the complete child collection
+        """
+        entity = LEVELS[level]
+        index = self.indexes[entity]
+        node = index.get(item.get("@iot.id"))
+        if node is None:
+            attrs = {k: v for k, v in item.items() if not _is_nav(k, LEVELS)}
+            node = Node(entity, attrs, parent)
+            index.add(node)
+
+            if level + 1 < len(LEVELS):
+                nav = LEVELS[level + 1]
+                children = node.children[nav] = NodeIndex()
+                for child in get_children(item, nav):
+                    children.add(self.add(child, get_children, level + 1, node))
+        return node
+
+
+def _is_nav(key, navs):
+    return key.split("@", 1)[0] in navs
+
+
+def graph_spec(selects=None, spec=None):
+    """
+    return the Query expanding Locations into Things and Datastreams.
+    ``selects`` maps an entity onto its $select, e.g. {"Things": ["id", "name"]}
+    """
+    selects = selects or {}
+    q = spec.copy() if spec is not None else Query()
+    if "Locations" in selects:
+        q.select = selects["Locations"]
+
+    datastreams = Expand("Datastreams", select=selects.get("Datastreams"))
+    things = Expand("Things", select=selects.get("Things"), expand=[datastreams])
+    q.expand.append(things)
+    return q
+
+
+# ============= EOF =============================================
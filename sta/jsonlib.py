@@ -0,0 +1,95 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def dumps(obj):
+    """
+    encode ``obj`` to UTF-8 JSON bytes, with orjson when it is installed
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+            )
+        except TypeError:
+            # e.g. integers wider than 64 bits, which only the stdlib encoder
+            # handles
+            pass
+    return json.dumps(obj).encode("utf-8")
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def response_json(resp):
+    """
+    decode the body of a requests or AsyncResponse response
+    """
+    return loads(resp.content)
+
+
+def json_kwargs(kw):
+    """
+    replace a ``json=`` request argument with a pre-encoded ``data=`` body
+    """
+    if kw.get("json") is None:
+        return kw
+
+    kw = dict(kw)
+    kw["data"] = dumps(kw.pop("json"))
+    kw["headers"] = dict(JSON_HEADERS, **(kw.get("headers") or {}))
+    return kw
+
+
+def iter_values(fileobj, meta):
+    """
+    incrementally parse a SensorThings collection page from ``fileobj`` and
+    yield the items of "value" as each one is complete. the top level
+    annotations (@iot.nextLink, @iot.count) are stored in ``meta``, which is
+    complete once the generator is exhausted. requires ijson
+    """
+    import ijson
+    from ijson.common import ObjectBuilder
+
+    builder = None
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == "value.item" and event in ("end_map", "end_array"):
+                yield builder.value
+                builder = None
+        elif prefix == "value.item":
+            if event in ("start_map", "start_array"):
+                builder = ObjectBuilder()
+                builder.event(event, value)
+            else:
+                yield value
+        elif prefix.startswith("@iot.") and "." not in prefix[5:]:
+            meta[prefix] = value
+
+
+# ============= EOF =============================================
@@ -0,0 +1,557 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+bulk load Locations and their Things from a CSV or GeoJSON file
+
+python -m sta.loader sites.csv --host localhost --user u --pwd p --zone 13
+
+the existing Locations are pulled with their Things in one paged query,
+every row is compared with them locally and only the creates and PATCHes
+that are needed are sent, on a pool of writer threads
+"""
+
+import csv
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import click
+
+from .diff import diff
+from .geometry import crs_key, points_from_utm
+from .sta_client import (
+    STAClient,
+    get_items,
+    iter_items,
+    make_geometry_point_from_latlon,
+)
+
+# row column -> site field. columns not listed become properties
+COLUMNS = {
+    "name": "name",
+    "description": "description",
+    "thing_name": "thing_name",
+    "thing_description": "thing_description",
+    "latitude": "latitude",
+    "longitude": "longitude",
+    "easting": "easting",
+    "northing": "northing",
+    "zone": "zone",
+    "srid": "srid",
+    "geometry": "geometry",
+}
+
+LOCATION_FIELDS = ("description", "properties", "location")
+THING_FIELDS = ("description", "properties")
+
+ACTIONS = ("created", "updated", "unchanged", "failed")
+
+
+def read_csv(path):
+    """
+    yield the rows of a CSV file as dicts, empty cells dropped
+    """
+    with open(path, "r", newline="") as rfile:
+        for row in csv.DictReader(rfile):
+            yield {k: v for k, v in row.items() if v not in ("", None)}
+
+
+def read_geojson(path):
+    """
+    yield the features of a GeoJSON FeatureCollection as dicts of their
+    properties plus "geometry". the file is parsed incrementally when ijson
+    is installed
+    """
+    with open(path, "rb") as rfile:
+        try:
+            import ijson
+        except ImportError:
+            features = json.load(rfile)["features"]
+        else:
+            features = ijson.items(rfile, "features.item", use_float=True)
+
+        for feature in features:
+            row = dict(feature.get("properties") or {})
+            row["geometry"] = feature.get("geometry")
+            yield row
+
+
+def read_rows(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".json", ".geojson"):
+        return read_geojson(path)
+    return read_csv(path)
+
+
+class Site:
+    """
+    one input row: a Location and the Thing at it
+    """
+
+    def __init__(self, row, name, description, properties):
+        self.row = row
+        self.name = name
+        self.description = description
+        self.properties = properties
+        self.thing_name = name
+        self.thing_description = description
+        self.geometry = None
+        # why the row cannot be loaded
+        self.error = None
+
+    def location_payload(self):
+        return {
+            "name": self.name,
+            "description": self.description,
+            "properties": self.properties,
+            "location": self.geometry,
+            "encodingType": "application/vnd.geo+json",
+        }
+
+    def thing_payload(self, location_id):
+        return {
+            "name": self.thing_name,
+            "description": self.thing_description,
+            "properties": self.properties,
+            "Locations": [{"@iot.id": location_id}],
+        }
+
+
+def make_sites(rows, start=0, columns=None, description="No Description", **crs):
+    """
+    turn a batch of rows into Sites. ``columns`` maps row columns to site
+    fields (see COLUMNS), the remaining columns become the properties of the
+    Location and the Thing
+
+    projected coordinates of the whole batch are transformed in one
+    points_from_utm call. ``crs`` holds its zone, srid and ellps defaults for
+    rows without zone/srid columns. a row whose coordinates cannot be
+    converted gets a Site with ``error`` set
+    """
+    if columns is None:
+        columns = COLUMNS
+
+    sites = []
+    utm = []
+    for i, row in enumerate(rows, start):
+        fields = {}
+        properties = {}
+        for k, v in row.items():
+            if k in columns:
+                fields[columns[k]] = v
+            else:
+                properties[k] = v
+
+        site = Site(
+            i,
+            fields.get("name"),
+            fields.get("description", description),
+            properties,
+        )
+        if "thing_name" in fields:
+            site.thing_name = fields["thing_name"]
+        if "thing_description" in fields:
+            site.thing_description = fields["thing_description"]
+
+        try:
+            if fields.get("geometry"):
+                site.geometry = fields["geometry"]
+            elif "latitude" in fields and "longitude" in fields:
+                site.geometry = make_geometry_point_from_latlon(
+                    float(fields["latitude"]), float(fields["longitude"])
+                )
+            elif "easting" in fields and "northing" in fields:
+                zone = fields.get("zone", crs.get("zone"))
+                srid = fields.get("srid", crs.get("srid"))
+                crs_key(zone, srid)
+                utm.append(
+                    (
+                        site,
+                        (float(fields["easting"]), float(fields["northing"])),
+                        (zone, srid),
+                    )
+                )
+        except (TypeError, ValueError) as e:
+            site.error = f"invalid coordinates. {e}"
+        sites.append(site)
+
+    if utm:
+        _convert_utm(utm, crs.get("ellps"))
+    return sites
+
+
+def _convert_utm(utm, ellps):
+    try:
+        points = points_from_utm(
+            [c[0] for _, c, _ in utm],
+            [c[1] for _, c, _ in utm],
+            zones=[z for _, _, (z, _) in utm],
+            srids=[s for _, _, (_, s) in utm],
+            ellps=ellps,
+        )
+    except Exception as e:
+        if len(utm) == 1:
+            utm[0][0].error = f"invalid coordinates. {e}"
+            return
+
+        # e.g. an unknown srid. find the rows that fail one by one
+        for item in utm:
+            _convert_utm([item], ellps)
+        return
+
+    for (site, _, _), point in zip(utm, points):
+        site.geometry = point
+
+
+class Entry:
+    """
+    local state of a server entity. ``iotid`` is a Future while the entity
+    is being created
+    """
+
+    def __init__(self, iotid, item, things=None):
+        self.iotid = iotid
+        self.item = item
+        self.things = things
+
+    def resolve(self):
+        if isinstance(self.iotid, Future):
+            return self.iotid.result()
+        return self.iotid
+
+
+class LoadSummary:
+    def __init__(self):
+        self.counts = {e: dict.fromkeys(ACTIONS, 0) for e in ("Locations", "Things")}
+        self.nrows = 0
+        self.errors = []
+        self.elapsed = 0
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    @property
+    def nwrites(self):
+        return sum(c["created"] + c["updated"] for c in self.counts.values())
+
+    def add(self, entity, action, site=None, error=None):
+        self.counts[entity][action] += 1
+        if error:
+            self.errors.append((site.row if site else None, entity, error))
+
+    def report(self):
+        lines = [
+            f"rows={self.nrows} writes={self.nwrites} elapsed={self.elapsed:0.1f}s"
+        ]
+        for entity, c in self.counts.items():
+            lines.append(f"{entity}: " + " ".join(f"{a}={c[a]}" for a in ACTIONS))
+        for row, entity, error in self.errors[:20]:
+            lines.append(f"row={row} {entity} {error}")
+        if len(self.errors) > 20:
+            lines.append(f"... {len(self.errors) - 20} more errors")
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return (
+            f"<LoadSummary rows={self.nrows} {self.counts} errors={len(self.errors)}>"
+        )
+
+
+class BulkLoader:
+    """
+    load Sites into SensorThings through an STAClient
+
+    loader = BulkLoader(client, workers=8)
+    summary = loader.load_file("wells.csv", zone=13)
+    print(summary.report())
+
+    at most ``max_in_flight`` sites are being written at a time. rows are
+    read and converted ``batch_size`` at a time. ``on_progress`` is called
+    with the LoadSummary every ``progress_every`` rows. with ``dry_run`` the
+    plan is counted but nothing is written
+    """
+
+    def __init__(
+        self,
+        client,
+        workers=8,
+        max_in_flight=None,
+        batch_size=1000,
+        columns=None,
+        description="No Description",
+        dry_run=False,
+        on_progress=None,
+        progress_every=1000,
+    ):
+        self._client = client
+        self._workers = max(1, workers)
+        self._max_in_flight = max_in_flight or 4 * self._workers
+        self._batch_size = batch_size
+        self._columns = columns
+        self._description = description
+        self._dry_run = dry_run
+        self._on_progress = on_progress
+        self._progress_every = progress_every
+        self._locations = None
+
+    def preload(self):
+        """
+        pull every Location with its Things into the local index. the client's
+        preload index is filled too so that later put_location/put_thing calls
+        need no lookups. returns the number of Locations and Things
+        """
+        client = self._client
+        session = client.session
+        base_url = client._base_url()
+        url = client._make_url(
+            "Locations?$select=id,name,description,properties,location"
+            "&$expand=Things($select=id,name,description,properties)"
+            "&$orderby=id asc"
+        )
+
+        locations = {}
+        nthings = 0
+        for loc in iter_items(url, session):
+            things = loc.pop("Things", [])
+            link = loc.pop("Things@iot.nextLink", None)
+            if link:
+                things = things + get_items(link, session)
+
+            lid = loc["@iot.id"]
+            client.index.load(base_url, "Things", f"Locations({lid})", things)
+            nthings += len(things)
+
+            # the first of duplicate names wins, as in STAClient._get_id
+            if loc.get("name") not in locations:
+                entries = {}
+                for thing in things:
+                    entries.setdefault(thing["name"], Entry(thing["@iot.id"], thing))
+                locations[loc.get("name")] = Entry(lid, loc, entries)
+
+        client.index.load(
+            base_url, "Locations", None, [e.item for e in locations.values()]
+        )
+        self._locations = locations
+        logging.info(f"preloaded locations={len(locations)} things={nthings}")
+        return len(locations), nthings
+
+    def load_file(self, path, **crs):
+        """
+        load a CSV or GeoJSON file, see make_sites for ``crs``
+        """
+        return self.load(read_rows(path), **crs)
+
+    def load(self, rows, **crs):
+        """
+        load an iterable of row dicts. returns a LoadSummary
+        """
+        if self._locations is None:
+            self.preload()
+
+        st = time.time()
+        summary = LoadSummary()
+        next_progress = self._progress_every
+        rows = iter(rows)
+        with ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix="sta-loader"
+        ) as pool:
+            pending = set()
+            while 1:
+                batch = list(itertools.islice(rows, self._batch_size))
+                if not batch:
+                    break
+
+                sites = make_sites(
+                    batch,
+                    summary.nrows,
+                    self._columns,
+                    self._description,
+                    **crs,
+                )
+                summary.nrows += len(batch)
+                for site in sites:
+                    steps = self._plan(site, summary)
+                    if not steps:
+                        continue
+
+                    if len(pending) >= self._max_in_flight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        self._collect(done, summary)
+                    pending.add(pool.submit(self._write, site, steps))
+
+                if summary.nrows >= next_progress:
+                    next_progress += self._progress_every
+                    self._progress(summary)
+
+            done, _ = wait(pending)
+            self._collect(done, summary)
+
+        summary.elapsed = time.time() - st
+        self._progress(summary)
+        return summary
+
+    def _progress(self, summary):
+        logging.info(
+            f"loaded rows={summary.nrows} writes={summary.nwrites} "
+            f"errors={len(summary.errors)}"
+        )
+        if self._on_progress:
+            self._on_progress(summary)
+
+    def _collect(self, done, summary):
+        for future in done:
+            for entity, action, site, error in future.result():
+                summary.add(entity, action, site, error)
+
+    def _plan(self, site, summary):
+        """
+        compare ``site`` with the local state and return the writes it needs
+        as [(entity, method, entry, payload), ...]. the local state is updated
+        to what the server holds once the writes are done, so later rows are
+        compared against it
+        """
+        if site.error:
+            summary.add("Locations", "failed", site, site.error)
+            return
+        if not site.name:
+            summary.add("Locations", "failed", site, "no name")
+            return
+        if not site.geometry:
+            summary.add("Locations", "failed", site, "no geometry")
+            return
+
+        steps = []
+        payload = site.location_payload()
+        location = self._locations.get(site.name)
+        if location is None:
+            location = Entry(Future(), payload, {})
+            self._locations[site.name] = location
+            steps.append(("Locations", "POST", location, payload))
+        else:
+            patch = diff(location.item, payload, LOCATION_FIELDS)
+            if patch:
+                location.item = dict(location.item, **patch)
+                steps.append(("Locations", "PATCH", location, patch))
+            else:
+                summary.add("Locations", "unchanged")
+
+        thing = location.things.get(site.thing_name)
+        if thing is None:
+            thing = Entry(Future(), site.thing_payload(None))
+            location.things[site.thing_name] = thing
+            steps.append(("Things", "POST", thing, None))
+        else:
+            patch = diff(thing.item, site.thing_payload(None), THING_FIELDS)
+            if patch:
+                thing.item = dict(thing.item, **patch)
+                steps.append(("Things", "PATCH", thing, patch))
+            else:
+                summary.add("Things", "unchanged")
+
+        if self._dry_run:
+            for entity, method, entry, _ in steps:
+                if isinstance(entry.iotid, Future):
+                    entry.iotid.set_result(None)
+                summary.add(entity, "created" if method == "POST" else "updated")
+            return
+
+        if steps:
+            return steps, location
+
+    def _write(self, site, plan):
+        steps, location = plan
+        events = []
+        for entity, method, entry, payload in steps:
+            error = None
+            try:
+                if method == "POST":
+                    if entity == "Things":
+                        lid = location.resolve()
+                        if lid is None:
+                            raise ValueError("location was not created")
+                        payload = site.thing_payload(int(lid))
+                    iotid = self._client._add(entity, payload)
+                    if iotid is None:
+                        error = "create failed"
+                    entry.iotid.set_result(iotid)
+                else:
+                    iotid = entry.resolve()
+                    if iotid is None:
+                        raise ValueError(f"{entity} was not created")
+                    resp = self._client.patch(
+                        self._client._make_url(f"{entity}({iotid})"), payload
+                    )
+                    if resp.status_code != 200:
+                        error = f"{resp.status_code} {resp.text}"
+            except Exception as e:
+                error = repr(e)
+            finally:
+                # never leave later rows waiting on an entity that failed
+                if isinstance(entry.iotid, Future) and not entry.iotid.done():
+                    entry.iotid.set_result(None)
+
+            if error:
+                events.append((entity, "failed", site, error))
+            else:
+                action = "created" if method == "POST" else "updated"
+                events.append((entity, action, site, None))
+        return events
+
+
+@click.command()
+@click.argument("path")
+@click.option("--host", default="localhost", help="SensorThings host")
+@click.option("--port", default=None, type=int)
+@click.option("--user", default=None)
+@click.option("--pwd", default=None)
+@click.option("--zone", default=None, type=int, help="UTM zone of easting/northing")
+@click.option("--srid", default=None, type=int, help="EPSG code of easting/northing")
+@click.option("--workers", default=8, help="concurrent writers")
+@click.option("--batch-size", default=1000, help="rows read and converted at a time")
+@click.option("--dry-run", is_flag=True, help="report the changes without writing")
+def main(path, host, port, user, pwd, zone, srid, workers, batch_size, dry_run):
+    """
+    create or update the Locations and Things of the rows in PATH, a CSV or
+    GeoJSON file
+    """
+    client = STAClient(host, user, pwd, port)
+
+    def on_progress(summary):
+        click.echo(
+            f"rows={summary.nrows} writes={summary.nwrites} "
+            f"errors={len(summary.errors)}",
+            err=True,
+        )
+
+    loader = BulkLoader(
+        client,
+        workers=workers,
+        batch_size=batch_size,
+        dry_run=dry_run,
+        on_progress=on_progress,
+    )
+    summary = loader.load_file(path, zone=zone, srid=srid)
+    click.echo(summary.report())
+
+
+if __name__ == "__main__":
+    main()
+
+# ============= EOF =============================================
@@ -0,0 +1,323 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# request latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+VERSION_SEGMENT = re.compile(r"/v1\.\d/")
+
+
+def url_entity(url):
+    """
+    the entity set or action a request url addresses, e.g.
+    ".../v1.1/Things(1)/Datastreams?$top=1" -> "Datastreams"
+    """
+    path = urlsplit(url).path
+    m = VERSION_SEGMENT.search(path)
+    if m:
+        path = path[m.end() :]
+    segment = path.rstrip("/").rsplit("/", 1)[-1]
+    return segment.split("(", 1)[0] or "root"
+
+
+def _labels(**kw):
+    return ",".join(f'{k}="{v}"' for k, v in kw.items())
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        return [(upper bound, cumulative count), ...] ending with "+Inf"
+        """
+        out = []
+        total = 0
+        for bound, n in zip(self.buckets + ("+Inf",), self.counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+    def quantile(self, q):
+        """
+        upper bound of the bucket holding the ``q`` quantile
+        """
+        if not self.count:
+            return
+        rank = q * self.count
+        for bound, n in self.cumulative():
+            if n >= rank:
+                return bound
+
+
+class Metrics:
+    """
+    client side request metrics, safe to share between threads
+
+    counts, latencies and bytes are recorded per (entity, method) by the
+    transport session (sta.transport), uploaded rows by ChunkUploader and
+    cache statistics are read from the registered caches when a snapshot is
+    taken
+
+    client.metrics.snapshot()
+    client.metrics.write("/var/lib/node_exporter/sta.prom")
+    client.metrics.serve(9464)
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._caches = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.errors = {}
+            self.latency = {}
+            self.bytes_sent = {}
+            self.bytes_received = {}
+            self.retries = {}
+            self.rows_uploaded = 0
+            self.rows_failed = 0
+            self.upload_seconds = 0
+            self.started = time.time()
+
+    def add_cache(self, name, cache):
+        """
+        report ``cache`` (anything with a ``stats`` dict holding hits and
+        misses, e.g. IDCache) under ``name``
+        """
+        if cache is not None:
+            self._caches[name] = cache
+
+    def observe_request(
+        self, url, method, status, elapsed, sent=0, received=0, retries=0
+    ):
+        entity = url_entity(url)
+        method = method.upper()
+        key = (entity, method)
+        with self._lock:
+            skey = (entity, method, str(status))
+            self.requests[skey] = self.requests.get(skey, 0) + 1
+            if status is None or status == "error" or int(status) >= 400:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+            hist = self.latency.get(key)
+            if hist is None:
+                hist = self.latency[key] = Histogram(self._buckets)
+            hist.observe(elapsed)
+
+            self.bytes_sent[key] = self.bytes_sent.get(key, 0) + sent
+            self.bytes_received[key] = self.bytes_received.get(key, 0) + received
+            if retries:
+                self.retries[key] = self.retries.get(key, 0) + retries
+
+    def observe_upload(self, nrows, nfailed, elapsed):
+        with self._lock:
+            self.rows_uploaded += nrows
+            self.rows_failed += nfailed
+            self.upload_seconds += elapsed
+
+    @property
+    def rows_per_second(self):
+        if self.upload_seconds:
+            return self.rows_uploaded / self.upload_seconds
+        return 0
+
+    def cache_stats(self):
+        return {name: cache.stats for name, cache in self._caches.items()}
+
+    def snapshot(self):
+        """
+        return the metrics as plain dicts keyed by "entity method"
+        """
+        with self._lock:
+            latency = {
+                f"{e} {m}": {
+                    "count": h.count,
+                    "mean": h.sum / h.count if h.count else 0,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                }
+                for (e, m), h in self.latency.items()
+            }
+            snap = {
+                "uptime": time.time() - self.started,
+                "requests": {
+                    f"{e} {m} {s}": n for (e, m, s), n in self.requests.items()
+                },
+                "errors": {f"{e} {m}": n for (e, m), n in self.errors.items()},
+                "latency": latency,
+                "bytes_sent": {f"{e} {m}": n for (e, m), n in self.bytes_sent.items()},
+                "bytes_received": {
+                    f"{e} {m}": n for (e, m), n in self.bytes_received.items()
+                },
+                "retries": {f"{e} {m}": n for (e, m), n in self.retries.items()},
+                "rows_uploaded": self.rows_uploaded,
+                "rows_failed": self.rows_failed,
+                "upload_seconds": self.upload_seconds,
+                "rows_per_second": self.rows_per_second,
+            }
+        snap["caches"] = self.cache_stats()
+        return snap
+
+    def to_prometheus(self, prefix="sta"):
+        """
+        return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, mtype, help_, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_}")
+            lines.append(f"# TYPE {prefix}_{name} {mtype}")
+            for suffix, labels, value in samples:
+                labels = f"{{{labels}}}" if labels else ""
+                lines.append(f"{prefix}_{name}{suffix}{labels} {value}")
+
+        with self._lock:
+            metric(
+                "requests_total",
+                "counter",
+                "requests by entity, method and status",
+                [
+                    ("", _labels(entity=e, method=m, status=s), n)
+                    for (e, m, s), n in sorted(self.requests.items())
+                ],
+            )
+
+            samples = []
+            for (e, m), h in sorted(self.latency.items()):
+                for bound, n in h.cumulative():
+                    samples.append(
+                        ("_bucket", _labels(entity=e, method=m, le=bound), n)
+                    )
+                samples.append(("_sum", _labels(entity=e, method=m), h.sum))
+                samples.append(("_count", _labels(entity=e, method=m), h.count))
+            metric(
+                "request_duration_seconds",
+                "histogram",
+                "request latency including retries",
+                samples,
+            )
+
+            for name, values, help_ in (
+                ("request_errors_total", self.errors, "requests failing with >= 400"),
+                ("bytes_sent_total", self.bytes_sent, "request body bytes"),
+                ("bytes_received_total", self.bytes_received, "response body bytes"),
+                ("retries_total", self.retries, "transport level retries"),
+            ):
+                metric(
+                    name,
+                    "counter",
+                    help_,
+                    [
+                        ("", _labels(entity=e, method=m), n)
+                        for (e, m), n in sorted(values.items())
+                    ],
+                )
+
+            metric(
+                "rows_uploaded_total",
+                "counter",
+                "observation rows created",
+                [("", "", self.rows_uploaded)],
+            )
+            metric(
+                "rows_failed_total",
+                "counter",
+                "observation rows rejected",
+                [("", "", self.rows_failed)],
+            )
+            metric(
+                "upload_seconds_total",
+                "counter",
+                "wall time spent uploading observations",
+                [("", "", self.upload_seconds)],
+            )
+
+        caches = self.cache_stats()
+        for key, mtype in (
+            ("hits", "counter"),
+            ("misses", "counter"),
+            ("size", "gauge"),
+        ):
+            metric(
+                f"cache_{key}" + ("_total" if mtype == "counter" else ""),
+                mtype,
+                f"id cache {key}",
+                [("", _labels(cache=n), s[key]) for n, s in sorted(caches.items())],
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, prefix="sta"):
+        """
+        atomically write the Prometheus text to ``path``, e.g. for the
+        node_exporter textfile collector
+        """
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as wfile:
+            wfile.write(self.to_prometheus(prefix))
+        os.replace(tmp, path)
+
+    def serve(self, port=9464, addr="127.0.0.1", prefix="sta"):
+        """
+        serve the Prometheus text at http://addr:port/metrics from a daemon
+        thread. returns the server, call shutdown() to stop it
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = metrics.to_prometheus(prefix).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        threading.Thread(
+            target=server.serve_forever, name="sta-metrics", daemon=True
+        ).start()
+        return server
+
+
+# ============= EOF =============================================
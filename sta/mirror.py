@@ -0,0 +1,289 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import json
+import sqlite3
+from datetime import datetime, timezone
+
+import click
+
+from .client import Client, verbose_message
+from .query import Query
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS observations (
+    datastream INTEGER NOT NULL,
+    iotid INTEGER NOT NULL,
+    phenomenon_time TEXT,
+    result_time TEXT,
+    result TEXT,
+    PRIMARY KEY (datastream, iotid)
+);
+CREATE INDEX IF NOT EXISTS observations_time
+    ON observations (datastream, phenomenon_time);
+CREATE TABLE IF NOT EXISTS sync_state (
+    datastream INTEGER PRIMARY KEY,
+    high_water TEXT,
+    synced_at TEXT,
+    nrows INTEGER
+);
+"""
+
+SELECT = ["id", "phenomenonTime", "resultTime", "result"]
+
+
+def _start_time(ptime):
+    # phenomenonTime may be an interval "start/end"
+    if ptime:
+        return ptime.split("/", 1)[0]
+
+
+class ObservationMirror:
+    """
+    local SQLite copy of the Observations of a set of Datastreams
+
+    mirror = ObservationMirror("obs.sqlite", client)
+    mirror.sync(1234)
+    for obs in mirror.observations(1234, start="2022-01-01"):
+        ...
+
+    ``sync`` requests only the Observations after the stored high-water mark
+    of the datastream, in (phenomenonTime, id) order so that Observations
+    sharing the high-water time are not skipped. rows are committed in batches
+    together with the high-water mark, so an interrupted sync resumes where
+    it stopped. results are stored as JSON to keep their type
+    """
+
+    def __init__(self, path, client=None, batch_size=5000):
+        self._path = path
+        self._client = client
+        self._batch_size = batch_size
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def high_water(self, datastream):
+        row = self._conn.execute(
+            "SELECT high_water FROM sync_state WHERE datastream=?",
+            (_datastream_id(datastream),),
+        ).fetchone()
+        if row:
+            return row[0]
+
+    def datastreams(self):
+        """
+        return [(datastream, high_water, synced_at, nrows), ...]
+        """
+        return self._conn.execute(
+            "SELECT datastream, high_water, synced_at, nrows FROM sync_state "
+            "ORDER BY datastream"
+        ).fetchall()
+
+    def sync(self, datastream, verbose=False, **kw):
+        """
+        fetch the Observations of ``datastream`` newer than its high-water
+        mark. returns the number of new rows
+        """
+        datastream = _datastream_id(datastream)
+        self._check_source()
+
+        hw = self.high_water(datastream)
+        spec = Query(select=SELECT, orderby="phenomenonTime asc,id asc")
+        if hw:
+            last_id = self._last_id(datastream, hw)
+            if last_id is None:
+                spec.add_filter(f"phenomenonTime ge {hw}")
+            else:
+                spec.add_filter(
+                    f"phenomenonTime gt {hw} or "
+                    f"(phenomenonTime eq {hw} and id gt {last_id})"
+                )
+
+        if verbose:
+            verbose_message(f"syncing datastream={datastream} high_water={hw}")
+
+        total = 0
+        rows = []
+        for obs in self._client.get_observations(
+            datastream, spec=spec, verbose=verbose, **kw
+        ):
+            rows.append(
+                (
+                    datastream,
+                    obs["@iot.id"],
+                    obs.get("phenomenonTime"),
+                    obs.get("resultTime"),
+                    json.dumps(obs.get("result")),
+                )
+            )
+            if len(rows) >= self._batch_size:
+                total += self._write(datastream, rows)
+                rows = []
+
+        total += self._write(datastream, rows)
+        if verbose:
+            verbose_message(f"synced datastream={datastream} new rows={total}")
+        return total
+
+    def sync_all(self, datastreams=None, verbose=False, **kw):
+        """
+        sync ``datastreams``, or every datastream already in the mirror.
+        returns {datastream: new rows}
+        """
+        if datastreams is None:
+            datastreams = [row[0] for row in self.datastreams()]
+        return {
+            _datastream_id(d): self.sync(d, verbose=verbose, **kw) for d in datastreams
+        }
+
+    def observations(self, datastream, start=None, end=None):
+        """
+        yield the mirrored Observations of ``datastream`` in phenomenonTime
+        order as dicts shaped like the SensorThings entities. ``start`` is
+        inclusive, ``end`` exclusive
+        """
+        sql = (
+            "SELECT iotid, phenomenon_time, result_time, result FROM observations "
+            "WHERE datastream=?"
+        )
+        params = [_datastream_id(datastream)]
+        if start:
+            sql = f"{sql} AND phenomenon_time >= ?"
+            params.append(start)
+        if end:
+            sql = f"{sql} AND phenomenon_time < ?"
+            params.append(end)
+
+        for iotid, ptime, rtime, result in self._conn.execute(
+            f"{sql} ORDER BY phenomenon_time, iotid", params
+        ):
+            yield {
+                "@iot.id": iotid,
+                "phenomenonTime": ptime,
+                "resultTime": rtime,
+                "result": json.loads(result),
+            }
+
+    def count(self, datastream):
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM observations WHERE datastream=?",
+            (_datastream_id(datastream),),
+        ).fetchone()[0]
+
+    def _last_id(self, datastream, hw):
+        """
+        the highest mirrored id among the Observations starting at ``hw``
+        """
+        return self._conn.execute(
+            "SELECT MAX(iotid) FROM observations WHERE datastream=? "
+            "AND (phenomenon_time=? OR phenomenon_time LIKE ?)",
+            (datastream, hw, f"{hw}/%"),
+        ).fetchone()[0]
+
+    def _write(self, datastream, rows):
+        if not rows:
+            return 0
+
+        hw = _start_time(rows[-1][2])
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._conn.execute(
+                "INSERT INTO sync_state VALUES (?, ?, ?, "
+                "(SELECT COUNT(*) FROM observations WHERE datastream=?)) "
+                "ON CONFLICT(datastream) DO UPDATE SET high_water=excluded.high_water, "
+                "synced_at=excluded.synced_at, nrows=excluded.nrows",
+                (datastream, hw, datetime.now(timezone.utc).isoformat(), datastream),
+            )
+        return len(rows)
+
+    def _check_source(self):
+        # a mirror belongs to one SensorThings instance
+        base_url = self._client.base_url
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key='base_url'"
+        ).fetchone()
+        if row is None:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO meta VALUES ('base_url', ?)", (base_url,)
+                )
+        elif row[0] != base_url:
+            raise ValueError(
+                f"{self._path} mirrors {row[0]}, not {base_url}. use another file"
+            )
+
+
+def _datastream_id(datastream):
+    if isinstance(datastream, dict):
+        datastream = datastream["@iot.id"]
+    return int(datastream)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("datastreams", nargs=-1, type=int)
+@click.option("--db", default="observations.sqlite", help="SQLite mirror file")
+@click.option("--base-url", default=None, help="SensorThings base url")
+@click.option("--user", default=None)
+@click.option("--pwd", default=None)
+@click.option("--verbose", is_flag=True)
+def sync(datastreams, db, base_url, user, pwd, verbose):
+    """
+    fetch new Observations of DATASTREAMS into the local mirror. without
+    DATASTREAMS every datastream already in the mirror is synced
+    """
+    client = Client(base_url, user, pwd)
+    with ObservationMirror(db, client) as mirror:
+        counts = mirror.sync_all(datastreams or None, verbose=verbose)
+        for datastream, n in counts.items():
+            click.echo(f"datastream={datastream} new rows={n}")
+
+
+@cli.command()
+@click.option("--db", default="observations.sqlite", help="SQLite mirror file")
+def status(db):
+    """
+    list the mirrored datastreams and their high-water marks
+    """
+    with ObservationMirror(db) as mirror:
+        for datastream, hw, synced_at, nrows in mirror.datastreams():
+            click.echo(
+                f"datastream={datastream} high_water={hw} synced_at={synced_at} "
+                f"nrows={nrows}"
+            )
+
+
+if __name__ == "__main__":
+    cli()
+
+# ============= EOF =============================================
@@ -0,0 +1,223 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class PageStreamer:
+    """
+    Iterate the pages of a SensorThings collection by following @iot.nextLink.
+
+    ``fetch`` is called with a url and the page index and must return the decoded page (a dict with
+    a ``value`` list and an optional ``@iot.nextLink``) or None on failure.
+
+    With ``prefetch`` > 0 pages are downloaded on a background thread and up to
+    ``prefetch`` pages are buffered ahead of the consumer. With ``prefetch=0``
+    each page is fetched inline when the consumer asks for it.
+    """
+
+    def __init__(self, fetch, start_url, pages=None, prefetch=0):
+        self._fetch = fetch
+        self._start_url = start_url
+        self._pages = pages
+        self._prefetch = prefetch
+        self._stop = threading.Event()
+
+    def __iter__(self):
+        if self._prefetch and self._prefetch > 0:
+            return self._iter_prefetch()
+        return self._iter_inline()
+
+    def close(self):
+        self._stop.set()
+
+    def _iter_pages(self):
+        # the next url is read from each page so this must be driven by a
+        # single thread
+        url = self._start_url
+        page_count = 0
+        while url and not self._stop.is_set():
+            if self._pages and page_count >= self._pages:
+                return
+
+            page = self._fetch(url, page_count)
+            yield page
+            if not page:
+                return
+
+            url = page.get("@iot.nextLink")
+            page_count += 1
+
+    def _iter_inline(self):
+        try:
+            yield from self._iter_pages()
+        finally:
+            self.close()
+
+    def _iter_prefetch(self):
+        q = queue.Queue(maxsize=self._prefetch)
+
+        def put(item):
+            while not self._stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+
+        def produce():
+            try:
+                for page in self._iter_pages():
+                    if not put(page):
+                        return
+            except Exception as e:
+                put(_Failure(e))
+                return
+            except BaseException as e:
+                # hand it to the consumer so it does not wait forever
+                put(_Failure(e))
+                raise
+            put(_END)
+
+        worker = threading.Thread(target=produce, name="sta-prefetch", daemon=True)
+        worker.start()
+        try:
+            while 1:
+                item = q.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.exc
+                yield item
+        finally:
+            self.close()
+
+
+class SkipRangeFetcher:
+    """
+    Fetch a collection of known size concurrently as $skip/$top windows.
+
+    ``make_url`` is called with (skip, top) and returns the url of a window.
+    ``fetch`` has the same contract as for PageStreamer. A window that the
+    server truncates (e.g. $top above the server's maxTop) is completed by
+    following its @iot.nextLink.
+
+    Iterating yields one list of items per window, in window order when
+    ``ordered`` is True, otherwise as windows complete. At most
+    ``2 * workers`` windows are in flight at once.
+
+    A failed page is fetched again up to ``retries`` times. A window that
+    still holds fewer items than it should raises RuntimeError rather than
+    leaving a hole in the middle of the collection.
+    """
+
+    def __init__(
+        self,
+        fetch,
+        make_url,
+        total,
+        page_size,
+        workers=4,
+        ordered=True,
+        pages=None,
+        retries=2,
+    ):
+        self._fetch = fetch
+        self._make_url = make_url
+        self._total = total
+        self._page_size = page_size
+        self._workers = workers
+        self._ordered = ordered
+        self._pages = pages
+        self._retries = retries
+        self._stop = threading.Event()
+
+    def close(self):
+        self._stop.set()
+
+    def windows(self):
+        skips = range(0, self._total, self._page_size)
+        if self._pages:
+            skips = skips[: self._pages]
+        return [(skip, min(self._page_size, self._total - skip)) for skip in skips]
+
+    def __iter__(self):
+        windows = deque(enumerate(self.windows()))
+        if not windows:
+            return
+
+        max_in_flight = max(1, 2 * self._workers)
+        with ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix="sta-skip"
+        ) as pool:
+            pending = deque()
+            try:
+                while windows or pending:
+                    while windows and len(pending) < max_in_flight:
+                        idx, (skip, top) = windows.popleft()
+                        pending.append(pool.submit(self._fetch_window, idx, skip, top))
+
+                    if self._ordered:
+                        future = pending.popleft()
+                        items = future.result()
+                    else:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        future = done.pop()
+                        pending.remove(future)
+                        items = future.result()
+
+                    yield items
+            finally:
+                self.close()
+                for future in pending:
+                    future.cancel()
+
+    def _fetch_window(self, idx, skip, top):
+        items = []
+        url = self._make_url(skip, top)
+        while url and len(items) < top and not self._stop.is_set():
+            for _ in range(self._retries + 1):
+                page = self._fetch(url, idx)
+                if page:
+                    break
+            else:
+                raise RuntimeError(f"failed fetching window skip={skip}. url={url}")
+
+            values = page.get("value")
+            if not values:
+                break
+
+            items.extend(values)
+            url = page.get("@iot.nextLink")
+
+        if len(items) < top and not self._stop.is_set():
+            raise RuntimeError(
+                f"window skip={skip} returned {len(items)} of {top} items. "
+                f"the collection changed while it was read"
+            )
+        return items[:top]
+
+
+# ============= EOF =============================================
@@ -0,0 +1,136 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from urllib.parse import quote
+
+# OData punctuation that must reach the server unescaped. everything else,
+# notably spaces, "+", "&" and "#", is percent encoded
+SAFE = "$,()'=;/:@*"
+
+
+def _join(values):
+    if isinstance(values, str):
+        return values
+    return ",".join(values)
+
+
+class Query:
+    """
+    SensorThings query options
+
+    Query(
+        filter="name eq 'foo'",
+        select=["id", "name"],
+        expand=[Expand("Things", select=["id", "name"],
+                       expand=[Expand("Datastreams", top=5)])],
+        orderby="id asc",
+        top=100,
+        skip=0,
+        count=True,
+    )
+
+    ``expand`` items are Expand objects or raw strings. ``result_format`` sets
+    FROST's $resultFormat (e.g. "dataArray")
+    """
+
+    def __init__(
+        self,
+        filter=None,
+        select=None,
+        expand=None,
+        orderby=None,
+        top=None,
+        skip=None,
+        count=None,
+        result_format=None,
+    ):
+        self.filter = filter
+        self.select = select
+        if isinstance(expand, (str, Expand)):
+            expand = [expand]
+        self.expand = list(expand or [])
+        self.orderby = orderby
+        self.top = top
+        self.skip = skip
+        self.count = count
+        self.result_format = result_format
+
+    def copy(self):
+        q = self.__class__.__new__(self.__class__)
+        q.__dict__.update(self.__dict__)
+        q.expand = list(self.expand)
+        return q
+
+    def add_filter(self, expression):
+        if not expression:
+            return
+        if self.filter:
+            self.filter = f"({self.filter}) and ({expression})"
+        else:
+            self.filter = expression
+
+    def options(self):
+        """
+        return the query options as a list of (name, raw value)
+        """
+        opts = []
+        if self.select:
+            opts.append(("$select", _join(self.select)))
+        if self.expand:
+            opts.append(("$expand", ",".join(_render_expand(e) for e in self.expand)))
+        if self.filter:
+            opts.append(("$filter", self.filter))
+        if self.orderby:
+            opts.append(("$orderby", _join(self.orderby)))
+        if self.top is not None:
+            opts.append(("$top", str(self.top)))
+        if self.skip:
+            opts.append(("$skip", str(self.skip)))
+        if self.count is not None:
+            opts.append(("$count", "true" if self.count else "false"))
+        if self.result_format:
+            opts.append(("$resultFormat", self.result_format))
+        return opts
+
+    def to_string(self):
+        """
+        the url encoded query string, without the leading "?"
+        """
+        return "&".join(f"{k}={quote(v, safe=SAFE)}" for k, v in self.options())
+
+
+class Expand(Query):
+    """
+    an expanded navigation property with its own nested query options
+    """
+
+    def __init__(self, name, **kw):
+        super().__init__(**kw)
+        self.name = name
+
+    def render(self):
+        opts = ";".join(f"{k}={v}" for k, v in self.options())
+        if opts:
+            return f"{self.name}({opts})"
+        return self.name
+
+
+def _render_expand(expand):
+    if isinstance(expand, Expand):
+        return expand.render()
+    return expand
+
+
+# ============= EOF =============================================
@@ -0,0 +1,124 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import tempfile
+from array import array
+from collections.abc import Sequence
+
+from .jsonlib import dumps, loads
+
+
+class SpillList(Sequence):
+    """
+    append-only list of JSON-able items holding at most ``max_in_memory``
+    items in memory. the rest are written as JSON lines to an anonymous
+    temporary file in ``dir`` and read back on access. only the file offset
+    of each spilled item stays in memory (8 bytes per item)
+
+    items = SpillList(max_in_memory=10000)
+    items.extend(iter_items(url))
+    items[123456]
+
+    the temporary file is removed by close(), also when used as a context
+    manager
+    """
+
+    def __init__(self, items=None, max_in_memory=10000, dir=None):
+        self._max = max_in_memory
+        self._dir = dir
+        self._memory = []
+        self._offsets = array("q")
+        self._file = None
+        if items is not None:
+            self.extend(items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return (
+            f"<SpillList n={len(self)} in_memory={len(self._memory)} "
+            f"spilled={len(self._offsets)}>"
+        )
+
+    def __len__(self):
+        return len(self._memory) + len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("SpillList index out of range")
+
+        nmem = len(self._memory)
+        if index < nmem:
+            return self._memory[index]
+
+        self._file.seek(self._offsets[index - nmem])
+        return loads(self._file.readline())
+
+    def __iter__(self):
+        yield from self._memory
+        if self._file is None:
+            return
+
+        # sequential read of the spilled items. appends made while iterating
+        # are not seen
+        nspilled = len(self._offsets)
+        pos = self._offsets[0]
+        for i in range(nspilled):
+            self._file.seek(pos)
+            line = self._file.readline()
+            pos = self._file.tell()
+            yield loads(line)
+
+    @property
+    def spilled(self):
+        return len(self._offsets)
+
+    def append(self, item):
+        if len(self._memory) < self._max and self._file is None:
+            self._memory.append(item)
+            return
+
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self._dir)
+
+        f = self._file
+        f.seek(0, 2)
+        self._offsets.append(f.tell())
+        f.write(dumps(item))
+        f.write(b"\n")
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._memory = []
+        self._offsets = array("q")
+
+
+# ============= EOF =============================================
@@ -14,60 +14,77 @@
 # limitations under the License.
 # ===============================================================================
 import logging
+import queue
+import threading
+import time
+from collections import deque
 from datetime import datetime
 import paho.mqtt.client as mqtt
-import json
-import pyproj
 import requests
 import re
 
+from .cache import (
+    PreloadIndex,
+    group_by_location,
+    location_filter,
+    payload_scope,
+    resolve_id_cache,
+    split_tag,
+)
 from .definitions import OM_Measurement, FOOT
-
-projections = {}
+from .diff import diff, link_expand
+from .geometry import points_from_utm
+from .jsonlib import dumps, loads, response_json
+from .metrics import Metrics
+from .spill import SpillList
+from .transport import make_session
+from .util import statimes
+from .upload import ChunkUploader, make_sizer
 
 IDREGEX = re.compile(r"(?P<id>\(\d+\))")
+TOPIC_DATASTREAM = re.compile(r"Datastreams\((?P<id>\d+)\)/Observations")
+
+# @iot.ids remembered per datastream to drop observations delivered twice
+RECENT_IDS = 1000
 
 
-def get_items(start_url):
-    items = []
+def iter_items(start_url, session=None):
+    """
+    yield the items of a collection page by page, following @iot.nextLink.
+    only the current page is held in memory
+    """
+    if session is None:
+        session = requests
 
-    def rget(url):
-        resp = requests.get(url)
-        data = resp.json()
+    url = start_url
+    while url:
+        resp = session.get(url)
+        data = response_json(resp)
         values = data["value"]
         logging.info("url={}, nvalues={}".format(url, len(values)))
 
-        items.extend(values)
-        try:
-            next_url = data["@iot.nextLink"]
-        except KeyError:
-            return
-        rget(next_url)
+        yield from values
+        url = data.get("@iot.nextLink")
 
-    rget(start_url)
-    return items
 
+def get_items(start_url, session=None, max_in_memory=None, spill_dir=None):
+    """
+    return every item of a collection as a list. with ``max_in_memory`` a
+    SpillList is returned instead, holding that many items in memory and
+    spilling the rest to a temporary file in ``spill_dir``
+    """
+    items = iter_items(start_url, session)
+    if max_in_memory is None:
+        return list(items)
+    return SpillList(items, max_in_memory, spill_dir)
 
-def make_geometry_point_from_utm(e, n, zone=None, ellps=None, srid=None):
-    if zone:
-        if zone in projections:
-            p = projections[zone]
-        else:
-            if ellps is None:
-                ellps = "WGS84"
-            p = pyproj.Proj(proj="utm", zone=int(zone), ellps=ellps)
-            projections[zone] = p
-    elif srid:
-        # get zone
-        if srid in projections:
-            p = projections[srid]
-            projections[srid] = p
-        else:
-            # p = pyproj.Proj(proj='utm', zone=int(zone), ellps='WGS84')
-            p = pyproj.Proj("EPSG:{}".format(srid))
 
-    lon, lat = p(e, n, inverse=True)
-    return make_geometry_point_from_latlon(lat, lon)
+def make_geometry_point_from_utm(e, n, zone=None, ellps=None, srid=None):
+    """
+    single point version of sta.geometry.points_from_utm. the Transformer of
+    each zone or srid is cached
+    """
+    return points_from_utm([e], [n], zone, srid, ellps)[0]
 
 
 def make_geometry_point_from_latlon(lat, lon):
@@ -79,11 +96,117 @@ def iotid(iid):
 
 
 class STAClient:
-    def __init__(self, host, user, pwd, port):
+    def __init__(
+        self,
+        host,
+        user,
+        pwd,
+        port,
+        id_cache=None,
+        session=None,
+        metrics=None,
+        **transport,
+    ):
+        """
+        ``id_cache`` is an IDCache for name -> @iot.id lookups. None uses the
+        process-wide cache, False disables caching
+
+        requests go through ``session``, by default a pooled keep-alive
+        session built by sta.transport.make_session from the ``transport``
+        keywords (pool_size, retries, backoff, connect_timeout, ...)
+
+        requests, uploads and id cache hits are recorded in ``metrics``, a
+        sta.metrics.Metrics created when None
+        """
         self._host = host
         self._user = user
         self._pwd = pwd
         self._port = port
+        self._id_cache = resolve_id_cache(id_cache)
+        self._index = PreloadIndex()
+        if metrics is None:
+            metrics = Metrics()
+        metrics.add_cache("id_cache", self._id_cache)
+        self._metrics = metrics
+        if session is None:
+            session = make_session(metrics=metrics, **transport)
+        self._session = session
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def id_cache(self):
+        return self._id_cache
+
+    @property
+    def index(self):
+        return self._index
+
+    def preload(
+        self, sensors=True, observed_properties=True, locations=None, datastreams=False
+    ):
+        """
+        pull reference entities into the preload index so that _get_id on
+        them is answered without a request
+
+        ``locations`` is an iterable of Location ids whose Things are loaded.
+        with ``datastreams`` the Datastreams of those Things are loaded too.
+        returns the number of entities indexed per entity type
+        """
+        base_url = self._base_url()
+        counts = {}
+        for tag, flag in (
+            ("Sensors", sensors),
+            ("ObservedProperties", observed_properties),
+        ):
+            if flag:
+                items = iter_items(
+                    self._make_url(f"{tag}?$orderby=id asc"), self._session
+                )
+                counts[tag] = self._index.load(base_url, tag, None, items)
+
+        if locations:
+            lids = list(locations)
+            expand = "Locations($select=id)"
+            if datastreams:
+                expand = f"{expand},Datastreams"
+
+            things = []
+            for fs in location_filter(lids):
+                things.extend(
+                    iter_items(
+                        self._make_url(
+                            f"Things?$filter={fs}&$expand={expand}&$orderby=id asc"
+                        ),
+                        self._session,
+                    )
+                )
+
+            counts["Things"] = 0
+            for lid, group in group_by_location(things, lids).items():
+                counts["Things"] += self._index.load(
+                    base_url, "Things", f"Locations({lid})", group
+                )
+
+            if datastreams:
+                counts["Datastreams"] = 0
+                for thing in things:
+                    items = thing.get("Datastreams", [])
+                    url = thing.get("Datastreams@iot.nextLink")
+                    if url:
+                        items = items + get_items(url, self._session)
+                    counts["Datastreams"] += self._index.load(
+                        base_url, "Datastreams", f"Things({thing['@iot.id']})", items
+                    )
+
+        logging.info(f"preloaded {counts}")
+        return counts
 
     @staticmethod
     def make_st_time(ts):
@@ -96,7 +219,24 @@ class STAClient:
         else:
             return ts
 
-    def get_locations(self, fs=None, orderby=None):
+    @staticmethod
+    def make_st_times(tss):
+        """
+        batch version of make_st_time, see sta.util.statimes
+        """
+        return statimes(tss)
+
+    def get_locations(self, fs=None, orderby=None, max_in_memory=None, spill_dir=None):
+        """
+        see get_items for ``max_in_memory`` and ``spill_dir``
+        """
+        url = self._locations_url(fs, orderby)
+        return get_items(url, self._session, max_in_memory, spill_dir)
+
+    def iter_locations(self, fs=None, orderby=None):
+        return iter_items(self._locations_url(fs, orderby), self._session)
+
+    def _locations_url(self, fs=None, orderby=None):
         params = []
         base = "Locations"
         if fs:
@@ -108,13 +248,13 @@ class STAClient:
             params = "&".join(params)
             base = f"{base}?{params}"
 
-        url = self._make_url(base)
-
-        return get_items(url)
+        return self._make_url(base)
 
     def delete_location(self, iotid):
         url = self._make_url(f"Locations({iotid})")
         self.delete(url)
+        if self._id_cache is not None:
+            self._id_cache.invalidate_iotid(self._base_url(), "Locations", iotid)
 
     def put_observed_property(self, name, description, **kw):
         obsprop_id = self.get_observed_property(name)
@@ -170,15 +310,39 @@ class STAClient:
         if properties:
             payload["properties"] = properties
 
-        ds = self.get_datastream(name, thing_id)
+        ds = self._get_item_by_name(
+            f"Things({thing_id})/Datastreams",
+            name,
+            extra_args=f"$expand={link_expand(payload)}",
+        )
         if ds:
+            ds = ds[0]
             ds_id = ds["@iot.id"]
-            if self._should_patch(ds, properties):
-                self.patch_datastream(ds_id, payload)
+            # found under the Thing, so its Thing link is already right
+            ds.setdefault("Thing", iotid(thing_id))
+            patch = diff(ds, payload)
+            ok = True
+            if patch:
+                resp = self.patch(self._make_url(f"Datastreams({ds_id})"), patch)
+                ok = resp.status_code == 200
             added = False
         else:
             ds_id = self._add("Datastreams", payload)
+            ok = ds_id is not None
             added = True
+
+        if not ok:
+            # the ids may come from the cache (put_sensor,
+            # put_observed_property) and point to deleted entities. resolve
+            # them by name next time
+            if self._id_cache is not None:
+                base_url = self._base_url()
+                for entity, eid in (
+                    ("Things", thing_id),
+                    ("ObservedProperties", obsprop_id),
+                    ("Sensors", sensor_id),
+                ):
+                    self._id_cache.invalidate_iotid(base_url, entity, eid)
         return ds_id, added
 
     def get_sensor(self, name):
@@ -205,8 +369,8 @@ class STAClient:
             f"Datastreams({datastream_id})/Observations?$orderby=phenomenonTime desc&$top=1"
         )
         logging.info(f"request url: {url}")
-        resp = requests.get(url)
-        v = resp.json()
+        resp = self._session.get(url)
+        v = response_json(resp)
         # logging.info(f'v {v}')
 
         vs = v.get("value")
@@ -215,14 +379,15 @@ class STAClient:
             return vs[0].get("phenomenonTime")
 
     def delete(self, url):
-        resp = requests.delete(url, auth=(self._user, self._pwd))
+        resp = self._session.delete(url, auth=(self._user, self._pwd))
         if resp.status_code != 200:
             logging.info(resp, resp.text)
 
     def patch(self, url, payload):
-        resp = requests.patch(url, auth=(self._user, self._pwd), json=payload)
+        resp = self._session.patch(url, auth=(self._user, self._pwd), json=payload)
         if resp.status_code != 200:
             logging.info(resp, resp.text)
+        return resp
 
     def patch_thing(self, iotid, payload):
         url = self._make_url(f"Things({iotid})")
@@ -239,71 +404,122 @@ class STAClient:
     def put_location(
         self, name, description, properties, utm=None, latlon=None, verbose=False
     ):
-        lid = self.get_location_id(name)
-        if lid is None:
-            geometry = None
-            if utm:
-                geometry = make_geometry_point_from_utm(*utm)
-            elif latlon:
-                geometry = make_geometry_point_from_latlon(*latlon)
-
-            if geometry:
-                payload = {
-                    "name": name,
-                    "description": description,
-                    "properties": properties,
-                    "location": geometry,
-                    "encodingType": "application/vnd.geo+json",
-                }
-                return self._add("Locations", payload, verbose=verbose), True
-            else:
-                logging.info(
-                    "failed to construct geometry. need to specify utm or latlon"
-                )
-                raise Exception
-        else:
-            self.patch_location(
-                lid, {"properties": properties, "description": description}
+        location = self._get_existing("Locations", name)
+        if location is not None:
+            lid = location["@iot.id"]
+            patch = self._patch_changes(
+                "Locations",
+                location,
+                {"properties": properties, "description": description},
             )
-            return lid, False
+            if patch is not None:
+                return lid, False
+            # deleted on the server since it was cached, create it again
 
-    def put_thing(
-        self, name, description, properties, location_id, check=True, verbose=False
-    ):
-        tid = None
-        if check:
-            tid = self.get_thing_id(name, location_id)
+        geometry = None
+        if utm:
+            geometry = make_geometry_point_from_utm(*utm)
+        elif latlon:
+            geometry = make_geometry_point_from_latlon(*latlon)
 
-        if tid is None:
+        if geometry:
             payload = {
                 "name": name,
                 "description": description,
                 "properties": properties,
-                "Locations": [{"@iot.id": location_id}],
+                "location": geometry,
+                "encodingType": "application/vnd.geo+json",
             }
-            return self._add("Things", payload, verbose=verbose)
+            return self._add("Locations", payload, verbose=verbose), True
         else:
-            self.patch_thing(
-                tid, {"properties": properties, "description": description}
+            logging.info("failed to construct geometry. need to specify utm or latlon")
+            raise Exception
+
+    def put_thing(
+        self, name, description, properties, location_id, check=True, verbose=False
+    ):
+        thing = None
+        if check:
+            thing = self._get_existing(f"Locations({location_id})/Things", name)
+
+        if thing is not None:
+            patch = self._patch_changes(
+                f"Locations({location_id})/Things",
+                thing,
+                {"properties": properties, "description": description},
             )
-        return tid
+            if patch is not None:
+                return thing["@iot.id"]
+            # deleted on the server since it was cached, create it again
+
+        payload = {
+            "name": name,
+            "description": description,
+            "properties": properties,
+            "Locations": [{"@iot.id": location_id}],
+        }
+        return self._add("Things", payload, verbose=verbose)
+
+    def add_observations(
+        self,
+        datastream_id,
+        components,
+        obs,
+        workers=4,
+        max_in_flight=None,
+        chunk_size=None,
+        sizer=None,
+        result_type=None,
+        columns=None,
+    ):
+        """
+        upload ``obs`` as CreateObservations chunks on a pool of ``workers``
+        threads. returns a list of ChunkResult, one per chunk
+
+        chunks are sized adaptively unless a fixed ``chunk_size`` or a
+        configured ChunkSizer is given
+
+        ``obs`` may also be columnar (NumPy structured array, dict of arrays
+        or DataFrame), see sta.columnar.to_data_array for ``result_type`` and
+        ``columns``
+        """
+        if obs is not None and not isinstance(obs, list):
+            from .columnar import to_data_array
+
+            obs = to_data_array(obs, components, result_type, columns)
 
-    def add_observations(self, datastream_id, components, obs):
         if not obs:
             return
 
-        n = 100
         nobs = len(obs)
         logging.info("nobservations: {}".format(nobs))
-        for i in range(0, nobs, n):
-            chunk = obs[i : i + n]
-            pd = self.observation_payload(datastream_id, components, chunk)
-            # logging.info('payload {}'.format(pd))
-            url = self._make_url("CreateObservations")
-            # logging.info('url: {}'.format(url))
-            # logging.info('payload: {}'.format(pd))
-            resp = requests.post(url, auth=("write", self._pwd), json=pd)
-            logging.info("response {}, {}".format(i, resp))
+        url = self._make_url("CreateObservations")
+
+        def make_payload(chunk):
+            return self.observation_payload(datastream_id, components, chunk)
+
+        def post(pd):
+            return self._session.post(url, auth=("write", self._pwd), json=pd)
+
+        def on_result(result):
+            if result.ok:
+                logging.info(
+                    "response {}, {}, nrows={}".format(
+                        result.start, result.status, result.nrows
+                    )
+                )
+            else:
+                logging.warning(
+                    "failed chunk {}/{}, {}".format(result.start, nobs, result.error)
+                )
+
+        sizer = make_sizer(chunk_size, sizer)
+        uploader = ChunkUploader(
+            post, workers, max_in_flight, on_result, sizer=sizer, metrics=self._metrics
+        )
+        results = uploader.upload(obs, make_payload)
+        logging.info("chunk sizes {}".format(sizer.report()))
+        return results
 
     @staticmethod
     def observation_payload(datastream_id, components, data):
@@ -338,15 +554,50 @@ class STAClient:
 
         return self._get_id(tag, name, extra_args=extra_args)
 
-    @staticmethod
-    def _should_patch(obj, properties):
-        patch = True
-        if all((v == obj["properties"].get(k) for k, v in properties.items() if v)):
-            patch = False
-        elif all((v == properties.get(k) for k, v in obj["properties"].items())):
-            patch = False
+    def _get_existing(self, tag, name):
+        """
+        return the entity named ``name`` in ``tag``, from the preload index
+        when its collection is loaded, otherwise from the server
+        """
+        key = self._cache_key(tag, name)
+        known, item = self._index.lookup(key)
+        if known:
+            return item
+
+        vs = self._get_item_by_name(tag, name)
+        if vs:
+            item = vs[0]
+            if self._id_cache is not None:
+                self._id_cache.set(key, item["@iot.id"])
+            return item
+
+    def _patch_changes(self, tag, obj, payload):
+        """
+        PATCH the fields of ``payload`` that differ from ``obj``, the entity
+        as returned by _get_existing. returns the PATCH body, empty if nothing
+        changed and no request was sent, None if ``obj`` no longer exists
+        """
+        patch = diff(obj, payload)
+        if patch:
+            entity, _ = split_tag(tag)
+            key = self._cache_key(tag, obj["name"])
+            resp = self.patch(self._make_url(f"{entity}({obj['@iot.id']})"), patch)
+            if resp.status_code == 200:
+                self._index.add(key, dict(obj, **patch))
+            elif resp.status_code == 404:
+                self._forget(key)
+                return
         return patch
 
+    def _forget(self, key):
+        """
+        drop the cached id and indexed copy of an entity the server answered
+        404 for
+        """
+        if self._id_cache is not None:
+            self._id_cache.invalidate(key)
+        self._index.discard(key)
+
     @staticmethod
     def _make_base(tag, **filters):
         def factory(k, v):
@@ -360,24 +611,44 @@ class STAClient:
 
     def _get_item(self, base, verbose=False):
         url = self._make_url(base)
-        resp = requests.get(url, auth=("read", "read"))
+        resp = self._session.get(url, auth=("read", "read"))
         if verbose:
             logging.info(f"Get item {base}")
 
-        j = resp.json()
+        j = response_json(resp)
         try:
             return j["value"]
         except KeyError:
             pass
 
     def _get_id(self, tag, name, verbose=False, **kw):
+        key = None
+        if not kw.get("extra_args"):
+            key = self._cache_key(tag, name)
+            known, item = self._index.lookup(key)
+            if known:
+                if item is not None:
+                    return item["@iot.id"]
+                return
+
+            if self._id_cache is not None:
+                iotid = self._id_cache.get(key)
+                if iotid is not None:
+                    return iotid
+
         vs = self._get_item_by_name(tag, name, **kw)
         if vs:
             iotid = vs[0]["@iot.id"]
             if verbose:
                 logging.info(f"Got tag={tag} name={name} iotid={iotid}")
+            if key is not None and self._id_cache is not None:
+                self._id_cache.set(key, iotid)
             return iotid
 
+    def _cache_key(self, tag, name):
+        entity, scope = split_tag(tag)
+        return self._base_url(), entity, scope, name
+
     def _get_item_by_name(self, tag, name, extra_args=None, verbose=False):
         tag = f"{tag}?$filter=name eq '{name}'"
         if extra_args:
@@ -390,43 +661,468 @@ class STAClient:
             logging.info(f"Add url={url}")
             logging.info(f"Add payload={payload}")
 
-        resp = requests.post(url, auth=(self._user, self._pwd), json=payload)
+        resp = self._session.post(url, auth=(self._user, self._pwd), json=payload)
 
         if extract_iotid:
             m = IDREGEX.search(resp.headers.get("location", ""))
-            # logging.info(f'Response={resp.json()}')
+            # logging.info(f'Response={response_json(resp)}')
 
             if m:
                 iotid = m.group("id")[1:-1]
                 if verbose:
                     logging.info(f"added {tag} {iotid}")
+                if "name" in payload:
+                    key = (
+                        self._base_url(),
+                        tag,
+                        payload_scope(tag, payload),
+                        payload["name"],
+                    )
+                    if self._id_cache is not None:
+                        self._id_cache.set(key, iotid)
+                    self._index.add(key, dict(payload, **{"@iot.id": iotid}))
                 return iotid
             else:
                 logging.info(f"failed adding {tag} {payload}")
-                logging.info(f"Response={resp.json()}")
+                logging.info(f"Response={response_json(resp)}")
 
     def _make_url(self, tag):
+        return f"{self._base_url()}/{tag}"
+
+    def _base_url(self):
         port = self._port
         if not port or port == 80:
             port = ""
         else:
             port = f":{port}"
 
-        return f"http://{self._host}{port}/FROST-Server/v1.1/{tag}"
+        return f"http://{self._host}{port}/FROST-Server/v1.1"
+
+
+class PublishResult:
+    """
+    outcome of one STAMQTTClient.add_observations call. ``delivered`` counts
+    the messages confirmed by on_publish (for QoS 0 that is when they were
+    written to the socket)
+    """
+
+    def __init__(self, datastream_id, n):
+        self.datastream_id = datastream_id
+        self.n = n
+        self.published = 0
+        self.delivered = 0
+        self.failed = 0
+        self.elapsed = 0
+        self.pending = 0
+
+    @property
+    def ok(self):
+        return not self.failed and not self.pending
+
+    @property
+    def rate(self):
+        if self.elapsed:
+            return self.delivered / self.elapsed
+        return 0
+
+    def __repr__(self):
+        return (
+            f"<PublishResult datastream={self.datastream_id} n={self.n} "
+            f"delivered={self.delivered} failed={self.failed} "
+            f"pending={self.pending} rate={self.rate:0.1f}/s>"
+        )
 
 
 class STAMQTTClient:
-    def __init__(self, host):
-        self._client = mqtt.Client("STA")
-        self._client.connect(host)
-
-    def add_observations(self, datastream_id, payloads):
-        client = self._client
-        for payload in payloads:
-            client.publish(
-                f"v1.0/Datastreams({datastream_id})/Observations",
-                payload=json.dumps(payload),
+    """
+    publish Observations over MQTT
+
+    the paho network loop runs on a background thread. at most
+    ``max_in_flight`` messages are unconfirmed at a time, publish blocks
+    until a confirmation frees a slot. confirmations arrive through
+    on_publish and are counted per add_observations call, ``on_delivery``
+    is called with (mid, datastream_id, latency) for each
+
+    ``client`` replaces the paho client, e.g. with an in-process fake broker
+    client for testing
+    """
+
+    def __init__(
+        self,
+        host,
+        port=1883,
+        qos=0,
+        max_in_flight=100,
+        keepalive=60,
+        version="v1.0",
+        client_id="STA",
+        client=None,
+        on_delivery=None,
+    ):
+        self._qos = qos
+        self._version = version
+        self._max_in_flight = max(1, max_in_flight)
+        self._slots = threading.BoundedSemaphore(self._max_in_flight)
+        self._lock = threading.RLock()
+        self._drained = threading.Condition(self._lock)
+        self._pending = {}
+        self._early = set()
+        self._on_delivery = on_delivery
+        self.delivered = 0
+        self.failed = 0
+
+        if client is None:
+            client = mqtt.Client(client_id)
+        self._client = client
+        client.on_publish = self._handle_publish
+        if qos:
+            client.max_inflight_messages_set(self._max_in_flight)
+        client.connect(host, port, keepalive)
+        client.loop_start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def topic(self, datastream_id):
+        return f"{self._version}/Datastreams({datastream_id})/Observations"
+
+    def add_observations(
+        self, datastream_id, payloads, batch_size=1000, wait=True, timeout=None
+    ):
+        """
+        publish ``payloads`` (Observation dicts) to the Observations topic of
+        ``datastream_id``. payloads are serialized ``batch_size`` at a time
+        ahead of publishing. with ``wait`` the call returns once every message
+        is confirmed or after ``timeout`` seconds, with the unconfirmed
+        messages counted in ``pending``. returns a PublishResult
+        """
+        payloads = list(payloads)
+        result = PublishResult(datastream_id, len(payloads))
+        topic = self.topic(datastream_id)
+        st = time.time()
+        for i in range(0, len(payloads), batch_size):
+            encoded = [dumps(p) for p in payloads[i : i + batch_size]]
+            for payload in encoded:
+                self._publish(topic, payload, result)
+
+        if wait:
+            self.wait(timeout)
+        result.elapsed = time.time() - st
+        with self._lock:
+            result.pending = sum(1 for r, _ in self._pending.values() if r is result)
+
+        logging.info(
+            "published datastream={} n={} delivered={} failed={} {:0.1f} msgs/s".format(
+                datastream_id, result.n, result.delivered, result.failed, result.rate
+            )
+        )
+        return result
+
+    def wait(self, timeout=None):
+        """
+        block until every published message is confirmed. returns False on
+        timeout
+        """
+        with self._drained:
+            return self._drained.wait_for(lambda: not self._pending, timeout)
+
+    def close(self, timeout=None):
+        self.wait(timeout)
+        self._client.loop_stop()
+        self._client.disconnect()
+
+    def _publish(self, topic, payload, result):
+        self._slots.acquire()
+        try:
+            # not under self._lock: paho may call on_publish from inside publish
+            info = self._client.publish(topic, payload=payload, qos=self._qos)
+        except Exception as e:
+            # e.g. an invalid topic or an oversized payload
+            self._slots.release()
+            with self._lock:
+                self.failed += 1
+                result.failed += 1
+            logging.warning(f"publish failed {e!r}")
+            return
+
+        rc = info.rc
+        if rc == mqtt.MQTT_ERR_NO_CONN and self._qos:
+            # paho keeps QoS>0 messages and sends them once reconnected, on_publish
+            # fires then
+            rc = mqtt.MQTT_ERR_SUCCESS
+
+        with self._lock:
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                self._slots.release()
+                self._early.discard(info.mid)
+                self.failed += 1
+                result.failed += 1
+                logging.warning(f"publish failed rc={rc} {mqtt.error_string(rc)}")
+                return
+
+            result.published += 1
+            self._pending[info.mid] = (result, time.time())
+            if info.mid in self._early:
+                # confirmed before it was registered
+                self._early.discard(info.mid)
+                self._confirm(info.mid)
+
+    def _handle_publish(self, client, userdata, mid):
+        with self._lock:
+            if mid not in self._pending:
+                self._early.add(mid)
+                return
+            self._confirm(mid)
+
+    def _confirm(self, mid):
+        result, st = self._pending.pop(mid)
+        self._slots.release()
+        self.delivered += 1
+        result.delivered += 1
+        if self._on_delivery is not None:
+            self._on_delivery(mid, result.datastream_id, time.time() - st)
+        if not self._pending:
+            self._drained.notify_all()
+
+
+class STAMQTTSubscriber:
+    """
+    follow new Observations of many Datastreams over MQTT
+
+    sub = STAMQTTSubscriber(host, [1, 2, 3], http=sta_client)
+    for datastream_id, obs in sub:
+        ...
+
+    observations are passed to ``callback(datastream_id, obs)`` when given,
+    otherwise queued for iteration (at most ``maxsize``, the network loop
+    waits when the queue is full until close() is called, messages it then
+    gives up on are counted in ``ndropped``). the newest phenomenonTime of each
+    datastream is tracked in ``last_seen``. after a reconnect the topics are
+    subscribed again and, with an ``http`` STAClient, the Observations
+    published while disconnected are fetched with a phenomenonTime filter.
+    observations delivered by both paths are dropped by @iot.id
+
+    ``last_seen`` may be seeded, e.g. from a mirror's high-water marks, to
+    catch up from there on the first connect
+    """
+
+    def __init__(
+        self,
+        host,
+        datastreams=(),
+        port=1883,
+        qos=1,
+        version="v1.1",
+        callback=None,
+        http=None,
+        last_seen=None,
+        maxsize=10000,
+        keepalive=60,
+        client_id="",
+        client=None,
+    ):
+        self._qos = qos
+        self._version = version
+        self._callback = callback
+        self._http = http
+        self._lock = threading.RLock()
+        self._queue = queue.Queue(maxsize)
+        self._datastreams = set()
+        self._recent = {}
+        self._connected_once = False
+        self._closed = False
+        self.last_seen = dict(last_seen or {})
+        self.ncaught_up = 0
+        self.ndropped = 0
+
+        for d in datastreams:
+            self._datastreams.add(int(d))
+
+        if client is None:
+            client = mqtt.Client(client_id)
+        self._client = client
+        client.on_connect = self._handle_connect
+        client.on_message = self._handle_message
+        client.connect(host, port, keepalive)
+        client.loop_start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self.observations()
+
+    def topic(self, datastream_id):
+        return f"{self._version}/Datastreams({datastream_id})/Observations"
+
+    def subscribe(self, datastreams):
+        # _datastreams is read on the network thread by _handle_connect
+        with self._lock:
+            new = [int(d) for d in datastreams if int(d) not in self._datastreams]
+            self._datastreams.update(new)
+        if new:
+            self._client.subscribe([(self.topic(d), self._qos) for d in new])
+
+    def unsubscribe(self, datastreams):
+        with self._lock:
+            ids = [int(d) for d in datastreams if int(d) in self._datastreams]
+            self._datastreams.difference_update(ids)
+        if ids:
+            self._client.unsubscribe([self.topic(d) for d in ids])
+
+    def observations(self, timeout=None):
+        """
+        yield (datastream_id, observation) until close() is called or no
+        observation arrives for ``timeout`` seconds
+        """
+        while 1:
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        # set first so a network loop blocked on a full queue gives up
+        self._closed = True
+        self._client.loop_stop()
+        self._client.disconnect()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # make room for the end of stream marker
+            try:
+                self._queue.get_nowait()
+                self.ndropped += 1
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(None)
+
+    def catch_up(self, marks=None):
+        """
+        fetch the Observations at or after ``marks`` ({datastream_id:
+        phenomenonTime}, default ``last_seen``) over HTTP. returns the number
+        delivered
+        """
+        if self._http is None:
+            return 0
+
+        if marks is None:
+            with self._lock:
+                marks = dict(self.last_seen)
+
+        with self._lock:
+            datastreams = list(self._datastreams)
+
+        n = 0
+        for d in datastreams:
+            since = marks.get(d)
+            if since is None:
+                continue
+
+            # ge, others may share the last seen time. the ones already
+            # delivered are dropped by @iot.id
+            url = self._http._make_url(
+                f"Datastreams({d})/Observations?$filter=phenomenonTime ge {since}"
+                f"&$orderby=phenomenonTime asc,id asc"
             )
+            for obs in iter_items(url, self._http.session):
+                if self._deliver(d, obs):
+                    n += 1
+
+        if n:
+            logging.info(f"caught up {n} observations over http")
+        self.ncaught_up += n
+        return n
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logging.warning(f"mqtt connect failed rc={rc}")
+            return
+
+        with self._lock:
+            datastreams = list(self._datastreams)
+        if datastreams:
+            client.subscribe([(self.topic(d), self._qos) for d in datastreams])
+
+        reconnect = self._connected_once
+        self._connected_once = True
+        if self._http is not None and (reconnect or self.last_seen):
+            # the marks as of the reconnect. live messages arriving while the
+            # catch-up runs move last_seen past the gap
+            with self._lock:
+                marks = dict(self.last_seen)
+            # not on the network thread, it has to keep receiving
+            threading.Thread(
+                target=self.catch_up,
+                args=(marks,),
+                name="sta-mqtt-catch-up",
+                daemon=True,
+            ).start()
+
+    def _handle_message(self, client, userdata, msg):
+        m = TOPIC_DATASTREAM.search(msg.topic)
+        if m is None:
+            return
+        try:
+            obs = loads(msg.payload)
+        except ValueError:
+            logging.warning(f"invalid observation on {msg.topic}")
+            return
+        self._deliver(int(m.group("id")), obs)
+
+    def _deliver(self, datastream_id, obs):
+        with self._lock:
+            iotid = obs.get("@iot.id")
+            if iotid is not None:
+                recent = self._recent.get(datastream_id)
+                if recent is None:
+                    recent = self._recent[datastream_id] = (set(), deque())
+                ids, order = recent
+                if iotid in ids:
+                    return False
+                ids.add(iotid)
+                order.append(iotid)
+                if len(order) > RECENT_IDS:
+                    ids.discard(order.popleft())
+
+            ptime = obs.get("phenomenonTime")
+            if ptime:
+                ptime = ptime.split("/", 1)[0]
+                last = self.last_seen.get(datastream_id)
+                if last is None or ptime > last:
+                    self.last_seen[datastream_id] = ptime
+
+            if self._callback is not None:
+                self._callback(datastream_id, obs)
+
+        if self._callback is None:
+            self._put((datastream_id, obs))
+        return True
+
+    def _put(self, item):
+        # wait for room while open, re-checking so close() never deadlocks
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        with self._lock:
+            self.ndropped += 1
 
 
 # ============= EOF =============================================
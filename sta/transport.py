@@ -0,0 +1,148 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import time
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .jsonlib import json_kwargs
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TransportSession(Session):
+    """
+    requests Session applying a default (connect, read) timeout to every
+    request that does not set its own. ``json=`` bodies are encoded with
+    sta.jsonlib. every request is recorded in ``metrics`` (a
+    sta.metrics.Metrics) when one is set
+    """
+
+    def __init__(self, timeout=None, metrics=None):
+        super().__init__()
+        self.timeout = timeout
+        self.metrics = metrics
+
+    def request(self, method, url, **kw):
+        if kw.get("timeout") is None:
+            kw["timeout"] = self.timeout
+        kw = json_kwargs(kw)
+        if self.metrics is None:
+            return super().request(method, url, **kw)
+
+        st = time.perf_counter()
+        try:
+            resp = super().request(method, url, **kw)
+        except BaseException:
+            self.metrics.observe_request(
+                url, method, "error", time.perf_counter() - st, _size(kw.get("data"))
+            )
+            raise
+
+        self.metrics.observe_request(
+            url,
+            method,
+            resp.status_code,
+            time.perf_counter() - st,
+            _size(resp.request.body),
+            _received(resp, kw.get("stream")),
+            _retries(resp),
+        )
+        return resp
+
+
+def _size(body):
+    if body is None or not isinstance(body, (bytes, str)):
+        return 0
+    return len(body)
+
+
+def _received(resp, stream):
+    # the wire size when the server sends it, which is the compressed size
+    # for gzip responses. the body of a streamed response is not read here
+    n = resp.headers.get("Content-Length")
+    if n is not None and n.isdigit():
+        return int(n)
+    if stream:
+        return 0
+    return len(resp.content)
+
+
+def _retries(resp):
+    retries = getattr(resp.raw, "retries", None)
+    if retries is None:
+        return 0
+    return len(retries.history)
+
+
+def make_retry(retries=3, backoff=0.5, statuses=RETRY_STATUSES, methods=None):
+    """
+    retry connection errors and ``statuses`` with exponential backoff,
+    honouring Retry-After. status and read retries only apply to ``methods``
+    (urllib3's idempotent methods by default, so POST and PATCH are not
+    replayed). after the last attempt the response is returned, not raised
+    """
+    kw = dict(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=statuses,
+        raise_on_status=False,
+    )
+    if methods is not None:
+        try:
+            return Retry(allowed_methods=frozenset(methods), **kw)
+        except TypeError:
+            # urllib3 < 1.26
+            return Retry(method_whitelist=frozenset(methods), **kw)
+    return Retry(**kw)
+
+
+def make_session(
+    pool_size=10,
+    retries=3,
+    backoff=0.5,
+    retry_statuses=RETRY_STATUSES,
+    retry_methods=None,
+    connect_timeout=10,
+    read_timeout=60,
+    gzip=True,
+    metrics=None,
+):
+    """
+    return a Session with a keep-alive connection pool of ``pool_size``
+    connections per host, retries (see make_retry) and default timeouts
+
+    ``pool_size`` should be at least the number of threads sharing the
+    session, otherwise connections are discarded instead of reused
+    """
+    session = TransportSession((connect_timeout, read_timeout), metrics)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=make_retry(retries, backoff, retry_statuses, retry_methods),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    session.headers["Accept-Encoding"] = "gzip, deflate" if gzip else "identity"
+    return session
+
+
+# ============= EOF =============================================
@@ -0,0 +1,315 @@
+# ===============================================================================
+# Copyright 2022 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .jsonlib import response_json
+
+IDREGEX = re.compile(r"(?P<id>\(\d+\))")
+
+
+class ChunkResult:
+    """
+    outcome of one CreateObservations request
+
+    iotids holds the id of each created Observation in row order, None for
+    rows the server rejected
+    """
+
+    def __init__(self, index, start, nrows):
+        self.index = index
+        self.start = start
+        self.nrows = nrows
+        self.status = None
+        self.iotids = []
+        self.error = None
+        self.elapsed = None
+        self.timeout = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def oversized(self):
+        """
+        True if the failure suggests the chunk was too large for the server
+        """
+        if self.timeout:
+            return True
+        return self.status is not None and (self.status == 413 or self.status >= 500)
+
+    @property
+    def retryable(self):
+        """
+        True if the server provably wrote nothing. CreateObservations is not
+        idempotent, a chunk that timed out or got a 5xx may have been
+        committed and is never sent again
+        """
+        return self.status == 413
+
+    @property
+    def nfailed(self):
+        if self.error is not None and not self.iotids:
+            return self.nrows
+        return sum(1 for i in self.iotids if i is None)
+
+    def __repr__(self):
+        return (
+            f"<ChunkResult index={self.index} start={self.start} nrows={self.nrows} "
+            f"status={self.status} error={self.error}>"
+        )
+
+
+def parse_create_observations(resp, result):
+    """
+    fill ``result`` from a CreateObservations response. The response body is
+    a list with the self link of each created Observation or "error"
+    """
+    result.status = resp.status_code
+    if resp.status_code != 201:
+        result.error = f"{resp.status_code} {resp.text}"
+        return
+
+    try:
+        links = response_json(resp)
+    except ValueError:
+        result.error = f"invalid response body {resp.text}"
+        return
+
+    for link in links:
+        m = IDREGEX.search(link)
+        result.iotids.append(m.group("id")[1:-1] if m else None)
+
+    nfailed = sum(1 for i in result.iotids if i is None)
+    if nfailed:
+        result.error = f"{nfailed}/{result.nrows} rows failed"
+
+
+class ChunkSizer:
+    """
+    Choose the number of rows per CreateObservations chunk.
+
+    In fixed mode (``adaptive=False``) every chunk has ``size`` rows. In
+    adaptive mode the size is multiplied by ``growth`` while the server latency
+    per row keeps improving by more than ``tolerance`` and settles on the best
+    size once it stops improving. A timeout, 413 or 5xx halves the size and
+    caps later chunks at the halved size. Only the rows of a 413
+    are sent again, other failed chunks are reported to the caller. Sizes
+    stay within ``min_size`` and ``max_size``.
+
+    ``history`` records (nrows, elapsed, status) for every attempt.
+    """
+
+    def __init__(
+        self,
+        size=100,
+        min_size=10,
+        max_size=10000,
+        adaptive=True,
+        growth=2.0,
+        tolerance=0.05,
+    ):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.size = min(max(size, self.min_size), self.max_size)
+        self.adaptive = adaptive
+        self.growth = growth
+        self.tolerance = tolerance
+        self.history = []
+
+        self._lock = threading.Lock()
+        self._best = None
+        self._best_size = self.size
+        self._settled = False
+
+    @property
+    def sizes(self):
+        return [h[0] for h in self.history]
+
+    def report(self):
+        sizes = self.sizes
+        if not sizes:
+            return "no chunks sent"
+        return (
+            f"nchunks={len(sizes)} min={min(sizes)} max={max(sizes)} "
+            f"final={self.size} adaptive={self.adaptive}"
+        )
+
+    def next_size(self):
+        with self._lock:
+            return self.size
+
+    def record(self, result, requested):
+        """
+        record the outcome of a chunk of ``requested`` rows and adapt the size.
+        returns True if the rows of a failed chunk should be retried
+        """
+        with self._lock:
+            self.history.append((result.nrows, result.elapsed, result.status))
+            if not self.adaptive:
+                return False
+
+            if result.oversized:
+                failed = result.nrows
+                # failed chunks are not resent, so do not grow back towards
+                # the size that failed
+                self.size = max(self.min_size, min(self.size, failed // 2))
+                self.max_size = max(self.min_size, min(self.max_size, self.size))
+                self._best_size = min(self._best_size, self.size)
+                self._settled = False
+                return result.retryable and failed > self.min_size
+
+            # a short tail chunk or a chunk sized before the last change says
+            # nothing about the current size
+            if not result.ok or result.nrows < requested or requested != self.size:
+                return False
+
+            per_row = result.elapsed / max(1, result.nrows)
+            if self._best is None or per_row < self._best * (1 - self.tolerance):
+                self._best = per_row
+                self._best_size = self.size
+                if not self._settled:
+                    self.size = min(self.max_size, int(self.size * self.growth))
+            else:
+                self._settled = True
+                self.size = self._best_size
+            return False
+
+
+def make_sizer(chunk_size=None, sizer=None):
+    """
+    ``sizer`` wins if given, a ``chunk_size`` alone means fixed size chunks,
+    otherwise chunks are sized adaptively
+    """
+    if sizer is not None:
+        return sizer
+    if chunk_size:
+        return ChunkSizer(chunk_size, min_size=1, max_size=chunk_size, adaptive=False)
+    return ChunkSizer()
+
+
+class ChunkUploader:
+    """
+    Upload CreateObservations chunks on a thread pool.
+
+    ``post`` is called with a chunk payload and returns a requests-like
+    response, or None for a dry run. At most ``max_in_flight`` chunks are
+    submitted at once (default 2 * workers) so the rows of a very large upload
+    are not all serialized up front. Chunk sizes come from ``sizer``, a
+    ChunkSizer, and are taken when each chunk is submitted. Uploaded rows and
+    wall time are recorded in ``metrics`` (a sta.metrics.Metrics) when given.
+    """
+
+    def __init__(
+        self,
+        post,
+        workers=4,
+        max_in_flight=None,
+        on_result=None,
+        sizer=None,
+        metrics=None,
+    ):
+        self._post = post
+        self._workers = max(1, workers)
+        if max_in_flight is None:
+            max_in_flight = 2 * self._workers
+        self._max_in_flight = max(1, max_in_flight)
+        self._on_result = on_result
+        if sizer is None:
+            sizer = ChunkSizer(adaptive=False)
+        self.sizer = sizer
+        self._metrics = metrics
+
+    def upload(self, rows, make_payload):
+        """
+        upload ``rows`` (a sequence supporting slicing). ``make_payload`` is
+        called with a slice of rows and returns the CreateObservations body.
+        returns a list of ChunkResult ordered by start row
+        """
+        st = time.time()
+        results = []
+        nrows = len(rows)
+        retries = deque()
+        offset = 0
+        index = 0
+        with ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix="sta-upload"
+        ) as pool:
+            pending = {}
+            while pending or retries or offset < nrows:
+                while len(pending) < self._max_in_flight:
+                    size = self.sizer.next_size()
+                    if retries:
+                        start, stop = retries.popleft()
+                        if stop - start > size:
+                            retries.appendleft((start + size, stop))
+                            stop = start + size
+                    elif offset < nrows:
+                        start, stop = offset, min(offset + size, nrows)
+                        offset = stop
+                    else:
+                        break
+
+                    result = ChunkResult(index, start, stop - start)
+                    index += 1
+                    payload = make_payload(rows[start:stop])
+                    future = pool.submit(self._send, result, payload)
+                    pending[future] = size
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    requested = pending.pop(future)
+                    result = future.result()
+                    if self.sizer.record(result, requested):
+                        retries.append((result.start, result.start + result.nrows))
+                        continue
+
+                    results.append(result)
+                    if self._on_result:
+                        self._on_result(result)
+
+        if self._metrics is not None:
+            # dry runs have neither a status nor an error and upload nothing.
+            # a POST that raised has no status but its rows failed
+            sent = [r for r in results if r.status is not None or r.error is not None]
+            nfailed = sum(r.nfailed for r in sent)
+            self._metrics.observe_upload(
+                sum(r.nrows for r in sent) - nfailed, nfailed, time.time() - st
+            )
+        return sorted(results, key=lambda r: r.start)
+
+    def _send(self, result, payload):
+        st = time.time()
+        try:
+            resp = self._post(payload)
+        except Exception as e:
+            result.error = repr(e)
+            result.timeout = "timeout" in type(e).__name__.lower()
+        else:
+            if resp is not None:
+                parse_create_observations(resp, result)
+        result.elapsed = time.time() - st
+        return result
+
+
+# ============= EOF =============================================
@@ -13,11 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
-from datetime import datetime
+import re
+from datetime import date, datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STFORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%m/%d/%Y %I:%M:%S %p")
+DIGITS = re.compile(r"\d")
 
 
 def statime(ts):
-    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%m/%d/%Y %I:%M:%S %p"):
+    for fmt in STFORMATS:
         try:
             t = datetime.strptime(ts, fmt)
             return f"{t.isoformat()}.000Z"
@@ -27,4 +36,100 @@ def statime(ts):
         return ts
 
 
+def _date_converter(ts):
+    return f"{date.fromisoformat(ts).isoformat()}T00:00:00.000Z"
+
+
+def _datetime_converter(ts):
+    return f"{datetime.fromisoformat(ts).isoformat()}.000Z"
+
+
+def _strptime_converter(fmt):
+    def func(ts):
+        return f"{datetime.strptime(ts, fmt).isoformat()}.000Z"
+
+    return func
+
+
+def _detect_converter(ts):
+    """
+    return a function converting strings shaped like ``ts``, or None if no
+    format in STFORMATS matches
+    """
+    for fmt in STFORMATS:
+        try:
+            datetime.strptime(ts, fmt)
+        except BaseException:
+            continue
+
+        # fromisoformat parses the iso formats far faster than strptime
+        if fmt == "%Y-%m-%d":
+            return _date_converter
+        elif fmt == "%Y-%m-%dT%H:%M:%S":
+            return _datetime_converter
+        return _strptime_converter(fmt)
+
+
+def _datetime_string(t):
+    # naive datetimes are taken as UTC, aware ones are converted to it
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc)
+    return f"{t:%Y-%m-%dT%H:%M:%S}.{t.microsecond // 1000:03d}Z"
+
+
+def statimes(tss):
+    """
+    batch version of statime. returns a list of ISO-8601 "Z" strings
+
+    ``tss`` is a sequence of strings or datetimes, or a NumPy datetime64
+    array. the format of the strings is detected once per distinct digit
+    pattern (e.g. "0000-00-00") instead of once per value. values that do not
+    match a known format are returned unchanged, as with statime
+    """
+    if np is not None and isinstance(tss, np.ndarray):
+        if np.issubdtype(tss.dtype, np.datetime64):
+            return datetime64_strings(tss)
+        tss = tss.tolist()
+
+    converters = {}
+    out = []
+    for ts in tss:
+        if isinstance(ts, datetime):
+            out.append(_datetime_string(ts))
+            continue
+        elif not isinstance(ts, str):
+            out.append(ts)
+            continue
+
+        pattern = DIGITS.sub("0", ts)
+        try:
+            func = converters[pattern]
+        except KeyError:
+            func = converters[pattern] = _detect_converter(ts)
+
+        if func is None:
+            out.append(ts)
+        else:
+            try:
+                out.append(func(ts))
+            except ValueError:
+                # same shape as the detected format but not a valid time
+                out.append(statime(ts))
+    return out
+
+
+def datetime64_strings(arr):
+    """
+    convert a NumPy datetime64 array to ISO-8601 "Z" strings with millisecond
+    precision in one vectorized call. NaT becomes None
+    """
+    strs = np.datetime_as_string(arr.astype("datetime64[ms]"), unit="ms")
+    out = np.char.add(strs, "Z").tolist()
+    nat = np.isnat(arr)
+    if nat.any():
+        for i in np.flatnonzero(nat):
+            out[i] = None
+    return out
+
+
 # ============= EOF =============================================